@@ -1,25 +1,76 @@
-from flask import Flask, render_template, request, jsonify, session
-import requests
+from flask import Flask, Response, render_template, request, jsonify, session, stream_with_context
 import os
+import time
 from datetime import timedelta, datetime
-import PyPDF2
-import io
 import re
 from youtube_transcript_api import YouTubeTranscriptApi
 from urllib.parse import urlparse, parse_qs
+from concurrent.futures import TimeoutError as FuturesTimeoutError, wait, FIRST_COMPLETED
 import json
-import html
-from cache import cached
+from cache import cached, start_janitor, Uncached
+import http_client
+from workers import submit_for_user, submit_bulk_for_user
+from canvas_api import paginate, fetch_list, CanvasAPIError, CanvasPaginationError
+from pdf_extract import (extract_pdf_pages, downloaded_pdf, spooled_pdf, PDFDownloadError,
+                         PDF_DOWNLOAD_CHUNK_BYTES, PDF_MAX_BYTES)
+from chunk_index import ContentBody, estimate_tokens, get_course_index
+from context_builder import ContextBuilder
+from course_matcher import get_course_matcher
+from html_text import extract_html_text
+from gemini import (discover_model, get_cached_content, key_fingerprint, model_registry, post_with_fallback,
+                    GEMINI_CONTEXT_CACHING)
 
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+app.config['MAX_CONTENT_LENGTH'] = PDF_MAX_BYTES
+
+# Purge expired cache entries and enforce the disk budget in the background.
+# Not in the PDF forkserver, which imports this file as __mp_main__ and must
+# stay single-threaded to fork its workers.
+if __name__ != '__mp_main__':
+    start_janitor()
 
 
 # DEFAULT Canvas URL - can be overridden per user
 DEFAULT_CANVAS_URL = 'https://swinburne.instructure.com/api/v1'
 
+# Max number of events shown in the upcoming schedule
+SCHEDULE_EVENT_LIMIT = 25
+
+# Max number of modules expanded in a content summary
+MODULE_LIMIT = 8
+
+# Course lists are cached per user (see CACHE_TTLS['courses']); hits older than
+# this are still served but refreshed in the background
+COURSE_LIST_REFRESH_AFTER = 120
+
+# Max characters of text extracted from one PDF per request
+PDF_CHAR_BUDGET = 20000
+
+# Max characters of text taken from a Canvas page / assignment description
+PAGE_CHAR_LIMIT = 20000
+ASSIGNMENT_DESCRIPTION_CHAR_LIMIT = 10000
+
+# Max seconds each course's fetch gets when scanning for upcoming assignments,
+# counted from when it starts rather than while it queues behind other courses
+ASSIGNMENT_COURSE_TIMEOUT = 15
+
+# Seconds /api/chat spends gathering Canvas data before calling Gemini; module
+# items that aren't ready by then are left out and keep loading into the cache
+CONTEXT_DEADLINE_SECONDS = 12
+
+# Streamed Gemini answers allow this long between chunks (connect, read)
+GEMINI_STREAM_TIMEOUT = (10, 45)
+
+# Token budget for page/PDF/transcript/assignment text in a module summary.
+# Over budget, each body is cut down to its chunks most relevant to the query.
+MODULE_CONTENT_TOKEN_BUDGET = 30000
+
+# Max tokens of an uploaded file included in the context
+UPLOADED_FILE_TOKEN_BUDGET = 10000
+
 
 @app.route('/')
 def home():
@@ -47,7 +98,7 @@ def login():
    
     try:
         headers = {'Authorization': f'Bearer {canvas_token}'}
-        response = requests.get(f'{canvas_url}/users/self', headers=headers, timeout=10)
+        response = http_client.get(f'{canvas_url}/users/self', headers=headers, timeout=10)
        
         if response.status_code == 200:
             user_data = response.json()
@@ -105,6 +156,7 @@ def chat():
     # CRITICAL FIX: Get conversation history from request (NOT from session)
     # This ensures uploaded file content is included in the conversation
     conversation_history = data.get('history', [])
+    stream = bool(data.get('stream', False))
     
     if not gemini_key:
         return jsonify({'error': 'Please provide Gemini API key'}), 400
@@ -112,9 +164,18 @@ def chat():
     try:
         canvas_url = session.get('canvas_url', DEFAULT_CANVAS_URL)
         canvas_context = get_canvas_context(user_query, session['canvas_token'], canvas_url, session['user_id'])
+        model_name = get_user_model(gemini_key)
         
+        if stream:
+            # Relay tokens as they are generated so the first words show up right away
+            return Response(
+                stream_with_context(relay_gemini_stream(canvas_context, gemini_key, conversation_history, model_name)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
         # Pass the conversation_history from the request to Gemini
-        response = call_gemini(canvas_context, gemini_key, conversation_history)
+        response = call_gemini(canvas_context, gemini_key, conversation_history, model_name)
         
         return jsonify({'response': response})
    
@@ -138,10 +199,13 @@ def upload_file():
         
         if filename.endswith('.pdf'):
             try:
-                pdf_file = io.BytesIO(file.read())
-                pdf_reader = PyPDF2.PdfReader(pdf_file)
-                for page in pdf_reader.pages:
-                    content += page.extract_text()
+                # Stream the upload to disk in chunks instead of reading it into memory
+                chunks = iter(lambda: file.stream.read(PDF_DOWNLOAD_CHUNK_BYTES), b'')
+                with spooled_pdf(chunks) as pdf_path:
+                    extracted = extract_pdf_pages(pdf_path)
+                content = extracted['text']
+                if not extracted['complete']:
+                    print(f"⚠️ PDF extraction for {filename} stopped early after page {extracted['end_page']}")
             except Exception as e:
                 return jsonify({'error': f'Error processing PDF file: {str(e)}'}), 500
         elif filename.endswith('.txt'):
@@ -167,41 +231,14 @@ def verify_key():
         return jsonify({'valid': False, 'message': 'API key is required'}), 400
    
     try:
-        test_models = [
-            'gemini-2.0-flash-exp',
-            'gemini-exp-1206',
-            'gemini-2.0-flash',
-            'gemini-2.5-flash',
-            'gemini-2.5-pro',
-            'gemini-2.5-pro-preview-03-25'
-        ]
-       
-        suitable_model = None
-       
-        for test_model in test_models:
-            print(f"Testing model: {test_model}")
-            test_url = f'https://generativelanguage.googleapis.com/v1beta/models/{test_model}:generateContent?key={api_key}'
-            test_payload = {
-                'contents': [{'parts': [{'text': 'Hi'}]}],
-                'generationConfig': {'maxOutputTokens': 10}
-            }
-           
-            try:
-                test_response = requests.post(test_url, json=test_payload, timeout=10)
-                if test_response.status_code == 200:
-                    suitable_model = test_model
-                    print(f"✅ Found working model: {suitable_model}")
-                    break
-                else:
-                    print(f"✖ Model {test_model} failed: {test_response.status_code} - {test_response.text}")
-            except Exception as e:
-                print(f"✖ Model {test_model} error: {str(e)}")
-                continue
+        fingerprint = key_fingerprint(api_key)
+        suitable_model = discover_model(fingerprint, api_key)
        
         if suitable_model:
-            with open('gemini_model.txt', 'w') as f:
-                f.write(suitable_model)
-            print(f"💾 Saved model to file: {suitable_model}")
+            # Remembered per user; other users' keys may have access to different models
+            session['gemini_model'] = suitable_model
+            session['gemini_key_fingerprint'] = fingerprint
+            model_registry.set(fingerprint, suitable_model)
             return jsonify({'valid': True, 'message': f'✅ API key is valid! Using model: {suitable_model}'})
         else:
             return jsonify({'valid': False, 'message': '✖ No suitable Gemini model found. Please check your API key and quota.'})
@@ -210,6 +247,23 @@ def verify_key():
         return jsonify({'valid': False, 'message': f'✖ Error: {str(e)}'}), 500
 
 
+def get_user_model(api_key):
+    """
+    Model picked for the user's key: session, then the in-memory registry,
+    then the default. Discovery probes are billable and slow, so they only
+    run from /api/verify-key, never on a chat turn.
+    """
+    fingerprint = key_fingerprint(api_key)
+    if session.get('gemini_key_fingerprint') == fingerprint and session.get('gemini_model'):
+        return session['gemini_model']
+
+    model_name = model_registry.get(fingerprint)
+    if model_name:
+        session['gemini_model'] = model_name
+        session['gemini_key_fingerprint'] = fingerprint
+    return model_name or model_registry.default_model
+
+
 def calculate_required_grade(current_grades, target_percentage=80):
     """
     Calculate what grades are needed on remaining assignments to achieve target percentage
@@ -295,7 +349,27 @@ def extract_youtube_id(url):
         return None
 
 
-@cached(key_prefix='video_transcript')
+def transcript_content_id(video_url, **_):
+    """Identify a transcript by YouTube video id, whatever URL form was used"""
+    video_id = extract_youtube_id(video_url)
+    return f"youtube:{video_id}" if video_id else None
+
+
+def pdf_content_id(pdf_url, file_data=None, start_page=0, **_):
+    """
+    Identify a Canvas file by host, file id and version so its extracted text
+    can be shared by every student in the unit. The caller has already fetched
+    file_data with the user's own token, so Canvas has done the access check.
+    """
+    if not file_data or not file_data.get('id'):
+        return None
+    version = file_data.get('updated_at') or file_data.get('modified_at') or ''
+    host = urlparse(pdf_url).netloc if pdf_url else ''
+    return f"canvas:{host}:file:{file_data['id']}:{version}:{file_data.get('size', '')}:from:{start_page}"
+
+
+@cached(key_prefix='video_transcript', key_args=('video_url',), per_user=False,
+        content_id=transcript_content_id)
 def get_video_transcript(video_url, user_id):
     """Get transcript from YouTube video"""
     try:
@@ -317,47 +391,47 @@ def get_video_transcript(video_url, user_id):
         return None
 
 
-@cached(key_prefix='pdf_text')
-def extract_pdf_text(pdf_url, headers, user_id):
-    """Extract text content from a PDF file"""
+@cached(key_prefix='pdf_text', key_args=('pdf_url', 'start_page'), content_id=pdf_content_id)
+def extract_pdf_text(pdf_url, headers, user_id, file_data=None, start_page=0):
+    """
+    Extract text content from a PDF file, up to PDF_CHAR_BUDGET characters.
+
+    Returns {'text', 'start_page', 'end_page', 'page_count', 'complete'};
+    pass end_page back as start_page to read the next part of the document.
+    """
     try:
         if not pdf_url:
             return None
         print(f"📄 Downloading PDF from: {pdf_url}")
-        response = requests.get(pdf_url, headers=headers, timeout=30)
-        if response.status_code == 200:
-            pdf_file = io.BytesIO(response.content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-           
-            text = ""
-            max_pages = min(50, len(pdf_reader.pages))
-            print(f"📖 Extracting text from {max_pages} pages...")
-           
-            for page_num in range(max_pages):
-                page = pdf_reader.pages[page_num]
-                page_text = page.extract_text() or ""
-                text += page_text + "\n"
-           
-            text = re.sub(r'\s+', ' ', text).strip()
-            extracted_text = text[:20000]
-            print(f"✅ Extracted {len(extracted_text)} characters from PDF")
-            return extracted_text
-        else:
-            print(f"✖ PDF fetch failed: {response.status_code}")
+        with downloaded_pdf(pdf_url, headers) as pdf_path:
+            print(f"📖 Extracting text from page {start_page + 1}...")
+            extracted = extract_pdf_pages(pdf_path, max_pages=50, start_page=start_page,
+                                          char_budget=PDF_CHAR_BUDGET)
+        print(f"✅ Extracted {len(extracted['text'])} characters from pages "
+              f"{extracted['start_page'] + 1}-{extracted['end_page']} of {extracted['page_count']}")
+        if not extracted['text']:
             return None
+        if not extracted['complete']:
+            # Cut short by a limit or a busy pool - use it now, but don't share it for days
+            print(f"⚠️ PDF extraction stopped early at page {extracted['end_page']}, not caching")
+            return Uncached(extracted)
+        return extracted
+    except PDFDownloadError as e:
+        print(f"✖ {str(e)}")
+        return None
     except Exception as e:
         print(f"Error extracting PDF: {str(e)}")
         return None
 
 
-@cached(key_prefix='page_content')
+@cached(key_prefix='page_content', key_args=('canvas_url', 'course_id', 'page_url'))
 def get_page_content(course_id, page_url, headers, canvas_url, user_id):
     """Fetch Canvas Page content"""
     try:
         print(f"📄 Attempting to fetch page: {page_url}")
        
         try:
-            response = requests.get(page_url, headers=headers, timeout=15)
+            response = http_client.get(page_url, headers=headers, timeout=15)
         except Exception:
             response = None
        
@@ -365,7 +439,7 @@ def get_page_content(course_id, page_url, headers, canvas_url, user_id):
             if page_url and not page_url.startswith('http'):
                 api_page_url = f"{canvas_url}/courses/{course_id}/pages/{page_url}"
                 try:
-                    response = requests.get(api_page_url, headers=headers, timeout=15)
+                    response = http_client.get(api_page_url, headers=headers, timeout=15)
                 except Exception:
                     response = None
        
@@ -382,121 +456,39 @@ def get_page_content(course_id, page_url, headers, canvas_url, user_id):
             page_data = response.json()
             page_body = page_data.get('body', '')
             page_title = page_data.get('title', '')
-            clean_text = re.sub(r'<br\s*/?>', '\n', page_body)
-            clean_text = re.sub('<p>', '\n', clean_text)
-            clean_text = re.sub('<[^<]+?>', '', clean_text)
-            clean_text = re.sub(r'\s+', ' ', clean_text).strip()
-            urls = re.findall(r'href=["\']([^"\\]+)["\\]', page_body)
+            extracted = extract_html_text(page_body, max_chars=PAGE_CHAR_LIMIT, max_links=10)
            
-            extracted_content = clean_text[:20000]
+            extracted_content = extracted['text']
             print(f"✅ Extracted {len(extracted_content)} characters from page")
             
             return {
                 'title': page_title,
                 'content': extracted_content,
-                'urls': urls[:10]
+                'urls': extracted['urls']
             }
         except ValueError:
-            html_text = response.text
-            title_match = re.search(r'<title>(.*?)</title>', html_text, re.IGNORECASE|re.DOTALL)
-            page_title = html.unescape(title_match.group(1)).strip() if title_match else ''
-            clean_text = re.sub(r'(<br\s*/?>|</p>|</div>)', '\n', html_text, flags=re.IGNORECASE)
-            clean_text = re.sub('<[^<]+?>', '', clean_text)
-            clean_text = re.sub(r'\s+', ' ', clean_text).strip()
-            urls = re.findall(r'href=["\']([^"\\]+)["\\]', html_text)
+            extracted = extract_html_text(response.text, max_chars=PAGE_CHAR_LIMIT, max_links=10)
             
-            extracted_content = clean_text[:20000]
+            extracted_content = extracted['text']
             print(f"✅ Extracted {len(extracted_content)} characters from HTML page")
             
             return {
-                'title': page_title,
+                'title': extracted['title'],
                 'content': extracted_content,
-                'urls': urls[:10]
+                'urls': extracted['urls']
             }
     except Exception as e:
         print(f"❌ Error fetching page content: {str(e)}")
         return None
 
 
-def find_target_course(query_lower, all_courses):
+def find_target_course(query_lower, all_courses, user_id=None):
     """Universal course finder - works for ANY course in ANY Canvas instance"""
     try:
-        print(f"🔍 Searching for course in query: '{query_lower}'")
-        
-        course_code_match = re.search(r'\b[A-Z]{2,4}\d{4,5}\b', query_lower.upper())
-        if course_code_match:
-            course_code = course_code_match.group(0)
-            for course in all_courses:
-                if course_code in course.get('course_code', '').upper():
-                    print(f"✅ Found course by code: {course.get('name')}")
-                    return course
-        
-        stop_words = {
-            'the', 'and', 'of', 'in', 'to', 'a', 'an', 'for', 'with', 'on', 'at',
-            '2024', '2025', '2026', 'semester', 'term', 'quarter', 'spring', 'fall', 'summer', 'winter',
-            'hs1', 'hs2', 'h1', 'h2', 's1', 's2', 't1', 't2', 't3', 'q1', 'q2', 'q3', 'q4',
-            'what', 'is', 'my', 'give', 'me', 'show', 'tell', 'about', 'from',
-            'summarize', 'summary', 'explain', 'describe', 'week', 'module', 'lecture'
-        }
-        
-        query_words = [word for word in query_lower.split() if word not in stop_words and len(word) > 2]
-        
-        best_match = None
-        best_score = 0
-        
-        for course in all_courses:
-            course_name = course.get('name', '').lower()
-            course_code = course.get('course_code', '').lower()
-            
-            score = 0
-            
-            for i in range(len(query_words)):
-                for j in range(i + 1, len(query_words) + 1):
-                    phrase = ' '.join(query_words[i:j])
-                    if phrase in course_name:
-                        score += (j - i) * 3
-                        print(f"  🔎 Phrase match '{phrase}' in {course.get('name')}: +{(j - i) * 3}")
-            
-            for word in query_words:
-                if word in course_name:
-                    score += 1
-                    print(f"  🔎 Word match '{word}' in {course.get('name')}: +1")
-                elif word in course_code:
-                    score += 2
-                    print(f"  🔎 Code match '{word}' in {course.get('course_code')}: +2")
-            
-            common_abbreviations = {
-                'oop': ['object oriented programming', 'object-oriented programming'],
-                'dsa': ['data structures', 'algorithms', 'data structures and algorithms'],
-                'ml': ['machine learning'],
-                'ai': ['artificial intelligence'],
-                'db': ['database'],
-                'os': ['operating system'],
-                'cn': ['computer network'],
-                'se': ['software engineering'],
-                'calc': ['calculus'],
-                'bio': ['biology'],
-                'chem': ['chemistry'],
-                'phys': ['physics'],
-                'stats': ['statistics'],
-                'econ': ['economics'],
-                'psych': ['psychology'],
-                'cs': ['computer science'],
-                'it': ['information technology']
-            }
-            
-            for word in query_words:
-                if word in common_abbreviations:
-                    for term in common_abbreviations[word]:
-                        if term in course_name:
-                            score += 5
-                            print(f"  🔎 Abbreviation match '{word}' -> '{term}' in {course.get('name')}: +5")
-                            break
-            
-            if score > best_score:
-                best_score = score
-                best_match = course
-                print(f"  ⭐ New best match: {course.get('name')} (score: {score})")
+        best_match, best_score = get_course_matcher(user_id, all_courses).match(query_lower)
+        if best_score is None:
+            print(f"✅ Found course by code: {best_match.get('name')}")
+            return best_match
         
         if best_match and best_score >= 2:
             print(f"✅ Found course: {best_match.get('name')} (final score: {best_score})")
@@ -510,96 +502,130 @@ def find_target_course(query_lower, all_courses):
     return None
 
 
-@cached(key_prefix='calendar_events')
-def get_calendar_events(headers, canvas_url, user_id, days_ahead=14):
-    """Fetch upcoming calendar events"""
+@cached(key_prefix='calendar_events', key_args=('canvas_url', 'days_ahead', 'limit'))
+def get_calendar_events(headers, canvas_url, user_id, days_ahead=14, limit=SCHEDULE_EVENT_LIMIT):
+    """Fetch upcoming calendar events (soonest first, at most `limit`)"""
     try:
         start_date = datetime.now().isoformat()
         end_date = (datetime.now() + timedelta(days=days_ahead)).isoformat()
        
-        response = requests.get(
+        events, complete = fetch_list(
             f'{canvas_url}/calendar_events',
-            headers=headers,
+            headers,
             params={
                 'start_date': start_date,
                 'end_date': end_date,
-                'per_page': 100,
                 'all_events': True
             },
-            timeout=10
+            limit=limit
         )
-       
-        if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"Calendar fetch failed: {response.status_code}")
-            return []
+        return events if complete else Uncached(events)
+    except CanvasAPIError as e:
+        print(f"Calendar fetch failed: {e.status_code}")
+        return []
     except Exception as e:
         print(f"Error fetching calendar: {str(e)}")
         return []
 
 
-@cached(key_prefix='upcoming_assignments')
-def get_upcoming_assignments(headers, canvas_url, user_id, days_ahead=14):
-    """Fetch upcoming assignments"""
-    try:
-        courses_response = requests.get(
-            f'{canvas_url}/users/self/courses?enrollment_state=active&per_page=100',
-            headers=headers,
-            timeout=10
+def get_pending_course_assignments(course, headers, canvas_url, cutoff_date):
+    """
+    Fetch one course's assignments and keep the pending ones due in the window.
+    Raises if any page fails, so the scan counts the course as missing.
+    """
+    assignments = paginate(
+        f"{canvas_url}/courses/{course['id']}/assignments",
+        headers,
+        params={'include[]': ['submission']}
+    )
+
+    pending = []
+    for assignment in assignments:
+        due_at = assignment.get('due_at')
+        submission = assignment.get('submission', {})
+       
+        workflow_state = submission.get('workflow_state', 'unsubmitted')
+        score = submission.get('score')
+        graded = submission.get('graded_at')
+       
+        is_pending = (
+            workflow_state in ['unsubmitted', 'pending_review'] or
+            (workflow_state == 'submitted' and not graded and score is None)
         )
        
-        if courses_response.status_code != 200:
-            print(f"Failed to fetch courses: {courses_response.status_code}")
+        if due_at and is_pending:
+            try:
+                due_date = datetime.fromisoformat(due_at.replace('Z', '+00:00'))
+                if due_date >= (datetime.now() - timedelta(days=7)) and due_date <= cutoff_date:
+                    assignment['course_name'] = course.get('name', 'Unknown Course')
+                    assignment['course_code'] = course.get('course_code', 'N/A')
+                    assignment['submission_status'] = workflow_state
+                    pending.append(assignment)
+            except Exception:
+                pass
+    return pending
+
+
+@cached(key_prefix='upcoming_assignments', key_args=('canvas_url', 'days_ahead'), call_only_args=('deadline',))
+def get_upcoming_assignments(headers, canvas_url, user_id, days_ahead=14, deadline=None):
+    """
+    Fetch upcoming assignments, scanning all active courses concurrently.
+    deadline (time.time()) cuts the scan short for a request that must answer by then.
+    """
+    try:
+        courses = fetch_courses(canvas_url, headers, 'active', user_id)
+        if not courses:
             return []
        
-        courses = courses_response.json()
         all_assignments = []
         cutoff_date = datetime.now() + timedelta(days=days_ahead)
-       
-        for course in courses:
+
+        started = {}
+
+        def scan_course(index, course):
+            started[index] = time.time()
+            return get_pending_course_assignments(course, headers, canvas_url, cutoff_date)
+
+        # At most PER_USER_CONCURRENCY courses are scanned at once for this user
+        futures = [submit_for_user(user_id, scan_course, index, course) for index, course in enumerate(courses)]
+
+        # Each course gets ASSIGNMENT_COURSE_TIMEOUT from its own start; the
+        # request deadline, if any, caps the whole scan
+        waiting = set(range(len(courses)))
+        while waiting:
+            now = time.time()
+            waiting = {
+                index for index in waiting
+                if not futures[index].done() and now < started.get(index, now) + ASSIGNMENT_COURSE_TIMEOUT
+            }
+            if not waiting or (deadline is not None and now >= deadline):
+                break
+            # Queued courses can't be waited on until they start, so wake up at
+            # least once per timeout to start their clocks
+            wake_at = min([started[index] + ASSIGNMENT_COURSE_TIMEOUT for index in waiting if index in started]
+                          + [now + ASSIGNMENT_COURSE_TIMEOUT] + ([deadline] if deadline is not None else []))
+            wait([futures[index] for index in waiting], timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+
+        failed_courses = 0
+        for course, future in zip(courses, futures):
+            if not future.done():
+                future.cancel()
+                failed_courses += 1
+                print(f"Timed out fetching assignments for course {course.get('id')}")
+                continue
             try:
-                assignments_response = requests.get(
-                    f"{canvas_url}/courses/{course['id']}/assignments",
-                    headers=headers,
-                    params={
-                        'per_page': 50,
-                        'include[]': ['submission']
-                    },
-                    timeout=10
-                )
-               
-                if assignments_response.status_code == 200:
-                    assignments = assignments_response.json()
-                    for assignment in assignments:
-                        due_at = assignment.get('due_at')
-                        submission = assignment.get('submission', {})
-                       
-                        workflow_state = submission.get('workflow_state', 'unsubmitted')
-                        score = submission.get('score')
-                        graded = submission.get('graded_at')
-                       
-                        is_pending = (
-                            workflow_state in ['unsubmitted', 'pending_review'] or
-                            (workflow_state == 'submitted' and not graded and score is None)
-                        )
-                       
-                        if due_at and is_pending:
-                            try:
-                                due_date = datetime.fromisoformat(due_at.replace('Z', '+00:00'))
-                                if due_date >= (datetime.now() - timedelta(days=7)) and due_date <= cutoff_date:
-                                    assignment['course_name'] = course.get('name', 'Unknown Course')
-                                    assignment['course_code'] = course.get('course_code', 'N/A')
-                                    assignment['submission_status'] = workflow_state
-                                    all_assignments.append(assignment)
-                            except Exception:
-                                pass
+                all_assignments.extend(future.result())
             except Exception as e:
+                failed_courses += 1
                 print(f"Error fetching assignments for course {course.get('id')}: {e}")
-                continue
        
-        all_assignments.sort(key=lambda x: x.get('due_at', ''))
+        # Deterministic order: due date, then course, then assignment id
+        all_assignments.sort(key=lambda x: (x.get('due_at') or '', x.get('course_id') or 0, x.get('id') or 0))
         print(f"📋 Found {len(all_assignments)} pending assignments")
+        if failed_courses:
+            # Missing courses would otherwise be hidden until the entry expires
+            print(f"⚠️ {failed_courses} course(s) missing from upcoming assignments, not caching")
+            return Uncached(all_assignments)
         return all_assignments
    
     except Exception as e:
@@ -607,53 +633,415 @@ def get_upcoming_assignments(headers, canvas_url, user_id, days_ahead=14):
         return []
 
 
-@cached(key_prefix='grades_info')
+@cached(key_prefix='grades_info', key_args=('canvas_url', 'course_id'))
 def get_grades_info(course_id, headers, canvas_url, user_id):
     """Fetch grades and submission status"""
     try:
-        response = requests.get(
+        assignments, complete = fetch_list(
             f'{canvas_url}/courses/{course_id}/assignments',
-            headers=headers,
-            params={'include[]': ['submission', 'score_statistics']},
-            timeout=10
+            headers,
+            params={'include[]': ['submission', 'score_statistics']}
         )
+        return assignments if complete else Uncached(assignments)
+    except CanvasAPIError as e:
+        print(f"Failed to fetch grades for course {course_id}: {e.status_code}")
+        return []
+    except Exception as e:
+        print(f"Error fetching grades: {str(e)}")
+        return []
+
+
+def render_module_item(item, course, headers, canvas_url, user_id):
+    """
+    Fetch and format one module item (page, file, video, assignment...) for the context.
+
+    Returns a list of strings and ContentBody parts; bodies are the long texts
+    that may be cut down to their most relevant chunks when the context is joined.
+    """
+    parts = []
+    item_title = item.get('title', 'Unknown')
+    item_type = item.get('type', 'Unknown')
+    item_url = item.get('html_url', '') or item.get('url', '')
+
+    parts.append(f"    {'─'*50}\n")
+    parts.append(f"    📌 {item_title} ({item_type})\n")
+
+    if item_type == 'Page':
+        page_url = item.get('url') or item.get('html_url')
+        if page_url:
+            print(f"📄 Fetching page: {item_title}")
+            page_content = get_page_content(course_id=course['id'], page_url=page_url, headers=headers, canvas_url=canvas_url, user_id=user_id)
+            if page_content and page_content.get('content'):
+                parts.append(f"\n    📄 PAGE CONTENT:\n")
+                parts.append(f"    {'-'*50}\n")
+                parts.append(ContentBody(f"page:{course['id']}:{page_url}", page_content['content']))
+                parts.append("\n")
+                parts.append(f"    {'-'*50}\n")
+
+                if page_content.get('urls'):
+                    parts.append(f"    🔗 Embedded links: {', '.join(page_content['urls'][:10])}\n")
+            else:
+                parts.append(f"    ⚠️ Could not fetch page content\n")
+
+            if item_url:
+                parts.append(f"    🔗 Page URL: {item_url}\n")
+
+    elif item_type == 'File':
+        file_id = item.get('content_id')
+        if file_id:
+            try:
+                file_response = http_client.get(
+                    f"{canvas_url}/files/{file_id}",
+                    headers=headers,
+                    timeout=10
+                )
+                if file_response.status_code == 200:
+                    file_data = file_response.json()
+                    file_name = file_data.get('filename', '')
+                    file_url = file_data.get('url', '')
+                    mime_type = file_data.get('content-type', '')
+
+                    parts.append(f"    📎 File: {file_name}\n")
+                    parts.append(f"    🔗 Download: {item_url}\n")
+
+                    if 'pdf' in mime_type.lower() or file_name.lower().endswith('.pdf'):
+                        parts.append(f"\n    📄 EXTRACTING PDF CONTENT...\n")
+                        pdf_text = extract_pdf_text(pdf_url=file_url, headers=headers, user_id=user_id, file_data=file_data)
+                        if pdf_text:
+                            parts.append(f"    {'-'*50}\n")
+                            parts.append(f"    PDF CONTENT (pages {pdf_text['start_page'] + 1}-{pdf_text['end_page']} of {pdf_text['page_count']}):\n")
+                            parts.append(ContentBody(f"file:{file_id}:{pdf_text['start_page']}", pdf_text['text']))
+                            parts.append("\n")
+                            parts.append(f"    {'-'*50}\n")
+                        else:
+                            parts.append(f"    ⚠️ Could not extract PDF text\n")
+            except Exception as e:
+                parts.append(f"    ⚠️ Error processing file: {str(e)}\n")
+
+    elif item_type == 'ExternalUrl':
+        external_url = item.get('external_url', item_url)
+        parts.append(f"    🔗 Link: {external_url}\n")
+
+        if external_url and ('youtube.com' in external_url or 'youtu.be' in external_url):
+            parts.append(f"\n    🎥 FETCHING VIDEO TRANSCRIPT...\n")
+            transcript = get_video_transcript(video_url=external_url, user_id=user_id)
+            if transcript:
+                parts.append(f"    {'-'*50}\n")
+                parts.append(f"    VIDEO TRANSCRIPT:\n")
+                parts.append(ContentBody(f"video:{external_url}", transcript[:25000]))
+                parts.append("\n")
+                parts.append(f"    {'-'*50}\n")
+            else:
+                parts.append(f"    ⚠️ Transcript not available\n")
+
+    elif item_type == 'Assignment':
+        assignment_id = item.get('content_id')
+        if assignment_id:
+            try:
+                assign_response = http_client.get(
+                    f"{canvas_url}/courses/{course['id']}/assignments/{assignment_id}",
+                    headers=headers,
+                    timeout=10
+                )
+                if assign_response.status_code == 200:
+                    assign_data = assign_response.json()
+                    description = assign_data.get('description', '')
+                    due_at = assign_data.get('due_at', 'No due date')
+                    points = assign_data.get('points_possible', 'N/A')
+
+                    parts.append(f"    📝 Assignment Details:\n")
+                    parts.append(f"       Due: {due_at}\n")
+                    parts.append(f"       Points: {points}\n")
+                    parts.append(f"    🔗 URL: {item_url}\n")
+
+                    if description:
+                        clean_desc = extract_html_text(description, max_chars=ASSIGNMENT_DESCRIPTION_CHAR_LIMIT)['text']
+                        parts.append(f"\n    📋 ASSIGNMENT DESCRIPTION:\n")
+                        parts.append(f"    {'-'*50}\n")
+                        parts.append(ContentBody(f"assignment:{assignment_id}", clean_desc))
+                        parts.append("\n")
+                        parts.append(f"    {'-'*50}\n")
+            except Exception as e:
+                parts.append(f"    ⚠️ Could not fetch assignment details\n")
+        else:
+            parts.append(f"    🔗 URL: {item_url}\n")
+
+    elif item_type == 'ExternalTool':
+        parts.append(f"    🔧 External Tool\n")
+        parts.append(f"    🔗 Link: {item_url}\n")
+
+    elif item_type == 'Quiz':
+        parts.append(f"    📝 Quiz\n")
+        parts.append(f"    🔗 Link: {item_url}\n")
+
+    elif item_type == 'Discussion':
+        parts.append(f"    💬 Discussion\n")
+        parts.append(f"    🔗 Link: {item_url}\n")
+
+    else:
+        parts.append(f"    🔗 URL: {item_url}\n")
+
+    parts.append("\n")
+
+    return parts
+
+def select_module_excerpts(query, course_key, rendered_items):
+    """
+    Choose which chunks of each content body to keep for this query.
+
+    Returns None when every body fits in MODULE_CONTENT_TOKEN_BUDGET (nothing is
+    trimmed), otherwise {doc_id: [chunk text, ...]} from the course's BM25 index.
+    """
+    bodies = [part for parts in rendered_items for part in parts if isinstance(part, ContentBody)]
+    total_tokens = sum(estimate_tokens(body.text) for body in bodies)
+    if total_tokens <= MODULE_CONTENT_TOKEN_BUDGET:
+        return None
+
+    index = get_course_index(course_key)
+    for body in bodies:
+        index.add_document(body.doc_id, body.text)
+    excerpts = index.select(query, [body.doc_id for body in bodies], MODULE_CONTENT_TOKEN_BUDGET)
+    print(f"✂️ Module content is ~{total_tokens} tokens, keeping the most relevant {sum(len(c) for c in excerpts.values())} chunks")
+    return excerpts
+
+
+def join_module_item(parts, excerpts):
+    """Join a rendered item, replacing content bodies with their selected excerpts"""
+    output = []
+    for part in parts:
+        if not isinstance(part, ContentBody):
+            output.append(part)
+        elif excerpts is None:
+            output.append(part.text)
+        elif excerpts.get(part.doc_id):
+            output.append('\n    [...]\n'.join(excerpts[part.doc_id]))
+        else:
+            output.append("    (Not among the most relevant content for this question - see the link above for the full text)")
+    return ''.join(output)
+
+
+def module_matches_number(module, number):
+    """Check whether a module name refers to the given week/module number"""
+    module_name_lower = module.get('name', '').lower()
+    return any([
+        f'week {number}' in module_name_lower,
+        f'week{number}' in module_name_lower,
+        f'week-{number}' in module_name_lower,
+        f'wk {number}' in module_name_lower,
+        f'wk{number}' in module_name_lower,
+        f'module {number}' in module_name_lower,
+        f'mod {number}' in module_name_lower,
+        f'unit {number}' in module_name_lower,
+        f'lesson {number}' in module_name_lower,
+        f'chapter {number}' in module_name_lower,
+        module_name_lower.startswith(f'{number} -'),
+        module_name_lower.startswith(f'{number}.'),
+        module_name_lower.startswith(f'{number}:')
+    ])
+
+
+def start_module_content(query_lower, course, headers, canvas_url, user_id, content):
+    """
+    Pick the modules the query is about and submit every item to the pool.
+
+    Notes (course header, week filter, errors) go straight into the content
+    section. Returns [(module, items, futures)], or None if there is nothing
+    to fetch. Submitting never blocks, so the caller can build other sections
+    while the items load.
+    """
+    try:
+        content.add(f"\n{'='*60}\n")
+        content.add(f"📖 COURSE: {course['name']} (Code: {course.get('course_code', 'N/A')})\n")
+        content.add(f"{'='*60}\n\n")
+        
+        number_match = None
+        if 'week' in query_lower or 'module' in query_lower:
+            number_match = re.search(r'(?:week|module|wk|mod)\s*(\d+)', query_lower)
+
+        # Walk the module pages lazily and stop once we have enough modules
+        modules = []
+        target_modules = []
+        try:
+            for m in paginate(
+                f"{canvas_url}/courses/{course['id']}/modules",
+                headers,
+                params={'include[]': 'items'},
+                prefetch=True
+            ):
+                modules.append(m)
+                if number_match and module_matches_number(m, number_match.group(1)):
+                    target_modules.append(m)
+                    print(f"✅ Matched module: {m.get('name')}")
+                if len(target_modules if number_match else modules) >= MODULE_LIMIT:
+                    break
+        except CanvasAPIError as e:
+            print(f"Failed to fetch modules for course {course.get('id')}: {e.status_code}")
+            content.add(f"  ⚠️ Could not fetch modules for this course.\n\n")
+            return None
+        except CanvasPaginationError as e:
+            print(f"⚠️ {str(e)}")
+            content.add(f"  ⚠️ Only some of this course's modules could be fetched.\n\n")
        
-        if response.status_code == 200:
-            return response.json()
+        if not modules:
+            content.add(f"  ℹ️ No modules found for this course.\n\n")
+            return None
+
+        print(f"📋 Available modules in {course['name']}:")
+        for mod in modules:
+            print(f"   - {mod.get('name', 'Unknown')}")
+        
+        if not number_match:
+            target_modules = modules
+        elif target_modules:
+            print(f"🔍 Filtering for {number_match.group(0)}, found {len(target_modules)} modules")
+            content.add(f"  🔍 Showing content for {number_match.group(0).title()}\n\n")
         else:
-            print(f"Failed to fetch grades for course {course_id}: {response.status_code}")
-            return []
+            print(f"⚠️ No modules found matching {number_match.group(0)}")
+            content.add(f"  ⚠️ {number_match.group(0).title()} not found. Available modules:\n")
+            for mod in modules[:15]:
+                content.add(f"     - {mod.get('name', 'Unknown')}\n")
+            content.add("\n")
+            target_modules = modules[:5]
+        
+        if not target_modules:
+            content.add(f"  ℹ️ No modules to display.\n\n")
+            return None
+       
+        # Resolve every item concurrently; finish_module_content assembles them in the original order
+        module_jobs = []
+        for module in target_modules[:MODULE_LIMIT]:
+            items = module.get('items', [])
+            futures = [
+                submit_bulk_for_user(user_id, render_module_item, item, course, headers, canvas_url, user_id)
+                for item in items[:20]
+            ]
+            module_jobs.append((module, items, futures))
+        return module_jobs
+
     except Exception as e:
-        print(f"Error fetching grades: {str(e)}")
+        print(f"Error fetching content: {str(e)}")
+        content.add(f"  ⚠️ Error: {str(e)}\n\n")
+        return None
+
+
+def finish_module_content(query, course, canvas_url, module_jobs, content, deadline):
+    """
+    Wait for the submitted items until the deadline and render them into the content section.
+
+    Items already running at the deadline are left to finish in the
+    background, so their page/PDF/transcript results land in the cache and
+    the next question about the same module gets them straight away. Items
+    still queued are cancelled rather than piling up behind the user's next
+    request.
+    """
+    try:
+        all_futures = [future for _, _, futures in module_jobs for future in futures]
+        wait(all_futures, timeout=max(0, deadline - time.time()))
+        cancelled = sum(future.cancel() for future in all_futures if not future.done())
+        still_loading = sum(not future.done() for future in all_futures)
+        if cancelled or still_loading:
+            print(f"⏳ {cancelled + still_loading}/{len(all_futures)} items not ready by the deadline: "
+                  f"{still_loading} left to warm the cache, {cancelled} cancelled")
+
+        rendered_modules = []
+        for module, items, futures in module_jobs:
+            rendered_items = []
+            for item, future in zip(items, futures):
+                if future.cancelled():
+                    rendered_items.append([
+                        f"    {'─'*50}\n",
+                        f"    📌 {item.get('title', 'Unknown')} ({item.get('type', 'Unknown')})\n",
+                        f"    ⏳ Not loaded in time - ask about this item on its own to include it\n\n",
+                    ])
+                    continue
+                if not future.done():
+                    rendered_items.append([
+                        f"    {'─'*50}\n",
+                        f"    📌 {item.get('title', 'Unknown')} ({item.get('type', 'Unknown')})\n",
+                        f"    ⏳ Still loading - this item will be included if you ask again in a moment\n\n",
+                    ])
+                    continue
+                try:
+                    rendered_items.append(future.result())
+                except Exception as e:
+                    print(f"Error processing item {item.get('title')}: {str(e)}")
+                    rendered_items.append([f"    ⚠️ Error processing {item.get('title', 'item')}: {str(e)}\n\n"])
+            rendered_modules.append((module, items, rendered_items))
+
+        # Over budget, only the chunks most relevant to the query are kept
+        excerpts = select_module_excerpts(
+            query,
+            f"{canvas_url}:{course['id']}",
+            [parts for _, _, rendered_items in rendered_modules for parts in rendered_items]
+        )
+
+        for module, items, rendered_items in rendered_modules:
+            module_name = module.get('name', 'Unknown Module')
+            module_id = module.get('id', 'N/A')
+            content.add(f"  📂 {module_name} (Module ID: {module_id})\n")
+            
+            if not items:
+                content.add(f"    ℹ️ No items in this module\n\n")
+                continue
+                
+            content.add(f"    📋 Found {len(items)} items in this module\n\n")
+            
+            for parts in rendered_items:
+                content.add(join_module_item(parts, excerpts))
+
+    except Exception as e:
+        print(f"Error fetching content: {str(e)}")
+        content.add(f"  ⚠️ Error: {str(e)}\n\n")
+
+
+@cached(key_prefix='courses', key_args=('canvas_url', 'enrollment_state'), refresh_after=COURSE_LIST_REFRESH_AFTER)
+def fetch_courses(canvas_url, headers, enrollment_state, user_id):
+    """Fetch every course in the given enrollment state, following pagination"""
+    try:
+        courses, complete = fetch_list(f'{canvas_url}/users/self/courses', headers, params={'enrollment_state': enrollment_state})
+        return courses if complete else Uncached(courses)
+    except Exception as e:
+        print(f"Failed to fetch {enrollment_state} courses: {str(e)}")
         return []
 
 
-def get_canvas_context(query, canvas_token, canvas_url, user_id):
+def course_list_by_deadline(future, enrollment_state, deadline):
+    """The fetch_courses result, or [] if it isn't ready by the request deadline"""
+    try:
+        return future.result(timeout=max(0, deadline - time.time()))
+    except FuturesTimeoutError:
+        print(f"⏳ {enrollment_state} course list not ready by the deadline, leaving it out")
+        return []
+
+
+def get_canvas_context(query, canvas_token, canvas_url, user_id, deadline=None):
     """Enhanced context fetcher with improved general query handling"""
     headers = {'Authorization': f'Bearer {canvas_token}'}
-    context = ''
+    deadline = deadline or time.time() + CONTEXT_DEADLINE_SECONDS
+
+    # Sections are output in this order; when over budget, the highest priority number is cut first
+    builder = ContextBuilder()
+    uploaded = builder.section('uploaded_file', priority=3, budget=UPLOADED_FILE_TOKEN_BUDGET)
+    course_lists = builder.section('course_lists', priority=1, budget=2000)
+    detection = builder.section('course_detection', priority=0)
+    calculation = builder.section('grade_calculation', priority=1, budget=3000)
+    schedule = builder.section('schedule', priority=2, budget=4000)
+    content = builder.section('module_content', priority=4)
+    grades = builder.section('grades', priority=2, budget=3000)
    
     if 'uploaded_file_content' in session:
-        context += f"📄 UPLOADED FILE: {session.get('uploaded_file_name', 'Unknown File')}\n"
-        context += f"CONTENT:\n{session['uploaded_file_content']}\n\n"
+        uploaded.add(f"📄 UPLOADED FILE: {session.get('uploaded_file_name', 'Unknown File')}\n")
+        uploaded.add(f"CONTENT:\n{session['uploaded_file_content']}\n\n")
 
     try:
         query_lower = query.lower()
        
         # Fetch all courses
-        courses_response = requests.get(
-            f'{canvas_url}/users/self/courses?enrollment_state=active&per_page=100',
-            headers=headers,
-            timeout=10
-        )
-        active_courses = courses_response.json() if courses_response.status_code == 200 and isinstance(courses_response.json(), list) else []
-       
-        past_response = requests.get(
-            f'{canvas_url}/users/self/courses?enrollment_state=completed&per_page=100',
-            headers=headers,
-            timeout=10
-        )
-        past_courses = past_response.json() if past_response.status_code == 200 and isinstance(past_response.json(), list) else []
+        # Both lists are cached per user; on a miss they are fetched concurrently
+        active_future = submit_for_user(user_id, fetch_courses, canvas_url, headers, 'active', user_id)
+        past_future = submit_for_user(user_id, fetch_courses, canvas_url, headers, 'completed', user_id)
+        active_courses = course_list_by_deadline(active_future, 'active', deadline)
+        past_courses = course_list_by_deadline(past_future, 'completed', deadline)
        
         all_courses = active_courses + past_courses
        
@@ -670,28 +1058,30 @@ def get_canvas_context(query, canvas_token, canvas_url, user_id):
         is_general_query = any(phrase in query_lower for phrase in general_queries)
         
         # Always show course lists
-        context += '📚 YOUR ACTIVE COURSES:\n'
+        course_lists.add('📚 YOUR ACTIVE COURSES:\n')
         for course in active_courses[:15]:
-            context += f"- {course.get('name', 'Unknown')} (ID: {course.get('id')}, Code: {course.get('course_code', 'N/A')})\n"
-        context += '\n'
+            course_lists.add(f"- {course.get('name', 'Unknown')} (ID: {course.get('id')}, Code: {course.get('course_code', 'N/A')})\n")
+        course_lists.add('\n')
        
         if past_courses:
-            context += '📜 YOUR PAST COURSES:\n'
+            course_lists.add('📜 YOUR PAST COURSES:\n')
             for course in past_courses[:10]:
-                context += f"- {course.get('name', 'Unknown')} (Code: {course.get('course_code', 'N/A')})\n"
-            context += '\n'
+                course_lists.add(f"- {course.get('name', 'Unknown')} (Code: {course.get('course_code', 'N/A')})\n")
+            course_lists.add('\n')
         
         # If it's a general query, skip course detection and return just the lists
         if is_general_query:
-            context += "ℹ️ QUERY TYPE: General course list request - no specific course needed\n\n"
+            detection.add("ℹ️ QUERY TYPE: General course list request - no specific course needed\n\n")
+            context = builder.build()
+            builder.log_usage()
             return context
         
         # For specific queries, try to find the target course
-        target_course = find_target_course(query_lower, all_courses)
+        target_course = find_target_course(query_lower, all_courses, user_id)
         
         if target_course:
-            context += f"🎯 DETECTED COURSE FOR THIS QUERY: {target_course.get('name')} (Code: {target_course.get('course_code', 'N/A')})\n"
-            context += f"   This query is specifically about: {target_course.get('name')}\n\n"
+            detection.add(f"🎯 DETECTED COURSE FOR THIS QUERY: {target_course.get('name')} (Code: {target_course.get('course_code', 'N/A')})\n")
+            detection.add(f"   This query is specifically about: {target_course.get('name')}\n\n")
         else:
             # Check if query needs a specific course
             needs_specific_course = any(word in query_lower for word in [
@@ -700,14 +1090,24 @@ def get_canvas_context(query, canvas_token, canvas_url, user_id):
             ])
             
             if needs_specific_course:
-                context += f"⚠️ NO SPECIFIC COURSE DETECTED in query: '{query}'\n"
-                context += f"   Please clarify which course you're asking about.\n\n"
+                detection.add(f"⚠️ NO SPECIFIC COURSE DETECTED in query: '{query}'\n")
+                detection.add(f"   Please clarify which course you're asking about.\n\n")
             else:
-                context += f"ℹ️ GENERAL QUERY - No specific course needed\n\n"
+                detection.add(f"ℹ️ GENERAL QUERY - No specific course needed\n\n")
        
+        # MODULES & CONTENT FETCHING - Only if target course exists.
+        # Items are submitted first and collected last, so the faster sections
+        # below are built while pages, PDFs and transcripts load.
+        module_jobs = None
+        wants_content = target_course and any(word in query_lower for word in ['module', 'week', 'material', 'content', 'lecture', 'learn',
+                                                  'topic', 'summarize', 'summary', 'pdf', 'file', 'video'])
+        if wants_content:
+            content.add('📚 DETAILED COURSE CONTENT:\n')
+            module_jobs = start_module_content(query_lower, target_course, headers, canvas_url, user_id, content)
+
         # GRADE CALCULATION - Only if target course exists
         if target_course and any(word in query_lower for word in ['calculate', 'need', 'hd', 'high distinction', 'required grade', 'what grade']):
-            context += '🎓 GRADE CALCULATION:\n\n'
+            calculation.add('🎓 GRADE CALCULATION:\n\n')
             grades_data = get_grades_info(course_id=target_course['id'], headers=headers, canvas_url=canvas_url, user_id=user_id)
             
             if grades_data:
@@ -728,45 +1128,46 @@ def get_canvas_context(query, canvas_token, canvas_url, user_id):
                 calc_result = calculate_required_grade(grades_data, target_grade)
                 
                 if calc_result:
-                    context += f"📊 Course: {target_course.get('name')}\n"
-                    context += f"🎯 Target Grade: {target_grade}% (HD)\n\n"
+                    calculation.add(f"📊 Course: {target_course.get('name')}\n")
+                    calculation.add(f"🎯 Target Grade: {target_grade}% (HD)\n\n")
                     
-                    context += f"📈 CURRENT STATUS:\n"
-                    context += f"   Points Earned: {calc_result['current_earned']}/{calc_result['current_possible']}\n"
-                    context += f"   Current Grade: {calc_result['current_percentage']}%\n\n"
+                    calculation.add(f"📈 CURRENT STATUS:\n")
+                    calculation.add(f"   Points Earned: {calc_result['current_earned']}/{calc_result['current_possible']}\n")
+                    calculation.add(f"   Current Grade: {calc_result['current_percentage']}%\n\n")
                     
                     if calc_result['remaining_assignments']:
-                        context += f"📝 REMAINING ASSIGNMENTS:\n"
+                        calculation.add(f"📝 REMAINING ASSIGNMENTS:\n")
                         for assignment in calc_result['remaining_assignments']:
-                            context += f"   - {assignment['name']}: {assignment['points']} points\n"
-                        context += f"   Total Remaining Points: {calc_result['remaining_points']}\n\n"
+                            calculation.add(f"   - {assignment['name']}: {assignment['points']} points\n")
+                        calculation.add(f"   Total Remaining Points: {calc_result['remaining_points']}\n\n")
                         
-                        context += f"🎯 WHAT YOU NEED:\n"
+                        calculation.add(f"🎯 WHAT YOU NEED:\n")
                         if calc_result['achievable']:
-                            context += f"   ✅ To achieve {target_grade}%, you need:\n"
-                            context += f"   📊 Average of {calc_result['required_percentage']}% on remaining assignments\n"
-                            context += f"   💯 That's {calc_result['points_needed']} more points out of {calc_result['remaining_points']} available\n\n"
+                            calculation.add(f"   ✅ To achieve {target_grade}%, you need:\n")
+                            calculation.add(f"   📊 Average of {calc_result['required_percentage']}% on remaining assignments\n")
+                            calculation.add(f"   💯 That's {calc_result['points_needed']} more points out of {calc_result['remaining_points']} available\n\n")
                             
                             if calc_result['required_percentage'] > 90:
-                                context += f"   ⚠️ Note: You'll need to score very high ({calc_result['required_percentage']}%) on remaining work!\n"
+                                calculation.add(f"   ⚠️ Note: You'll need to score very high ({calc_result['required_percentage']}%) on remaining work!\n")
                             elif calc_result['required_percentage'] < 50:
-                                context += f"   🎉 Great news! You only need {calc_result['required_percentage']}% on remaining work!\n"
+                                calculation.add(f"   🎉 Great news! You only need {calc_result['required_percentage']}% on remaining work!\n")
                         else:
-                            context += f"   ❌ Unfortunately, achieving {target_grade}% is no longer possible\n"
-                            context += f"   📊 Maximum achievable grade: {calc_result['current_percentage'] + calc_result['remaining_points']}%\n"
+                            calculation.add(f"   ❌ Unfortunately, achieving {target_grade}% is no longer possible\n")
+                            calculation.add(f"   📊 Maximum achievable grade: {calc_result['current_percentage'] + calc_result['remaining_points']}%\n")
                     else:
-                        context += calc_result.get('message', 'No remaining assignments')
+                        calculation.add(calc_result.get('message', 'No remaining assignments'))
                     
-                    context += '\n'
+                    calculation.add('\n')
             else:
-                context += "⚠️ Could not fetch grade data for this course.\n\n"
+                calculation.add("⚠️ Could not fetch grade data for this course.\n\n")
        
         # SCHEDULE & CALENDAR
         if any(word in query_lower for word in ['schedule', 'calendar', 'upcoming', 'due', 'deadline', 'when', 'next']):
-            context += '📅 YOUR UPCOMING SCHEDULE (Next 2 Weeks):\n\n'
+            schedule.add('📅 YOUR UPCOMING SCHEDULE (Next 2 Weeks):\n\n')
            
             calendar_events = get_calendar_events(headers=headers, canvas_url=canvas_url, user_id=user_id)
-            upcoming_assignments = get_upcoming_assignments(headers=headers, canvas_url=canvas_url, user_id=user_id)
+            upcoming_assignments = get_upcoming_assignments(headers=headers, canvas_url=canvas_url, user_id=user_id,
+                                                            deadline=deadline)
            
             all_events = []
            
@@ -801,260 +1202,45 @@ def get_canvas_context(query, canvas_token, canvas_url, user_id):
            
             if all_events:
                 current_date = None
-                for event in all_events[:25]:
+                for event in all_events[:SCHEDULE_EVENT_LIMIT]:
                     try:
                         dt = datetime.fromisoformat(event['date'].replace('Z', '+00:00'))
                         date_str = dt.strftime('%A, %B %d, %Y')
                         time_str = dt.strftime('%I:%M %p')
                        
                         if date_str != current_date:
-                            context += f"\n📆 {date_str}\n"
+                            schedule.add(f"\n📆 {date_str}\n")
                             current_date = date_str
                        
                         if event['type'] == 'assignment':
-                            context += f"  {event.get('status_emoji', '📝')} {event['title']} - {event['course']}\n"
-                            context += f"     ⏰ Due: {time_str}\n"
-                            context += f"     💯 Points: {event.get('points', 'N/A')}\n"
-                            context += f"     📊 Status: {event.get('status', 'unknown')}\n"
+                            schedule.add(f"  {event.get('status_emoji', '📝')} {event['title']} - {event['course']}\n")
+                            schedule.add(f"     ⏰ Due: {time_str}\n")
+                            schedule.add(f"     💯 Points: {event.get('points', 'N/A')}\n")
+                            schedule.add(f"     📊 Status: {event.get('status', 'unknown')}\n")
                             if event.get('url'):
-                                context += f"     🔗 Link: {event['url']}\n"
+                                schedule.add(f"     🔗 Link: {event['url']}\n")
                         else:
-                            context += f"  📅 {event['title']} - {event['course']}\n"
-                            context += f"     ⏰ Time: {time_str}\n"
+                            schedule.add(f"  📅 {event['title']} - {event['course']}\n")
+                            schedule.add(f"     ⏰ Time: {time_str}\n")
                             if event.get('url'):
-                                context += f"     🔗 Link: {event['url']}\n"
-                        context += '\n'
+                                schedule.add(f"     🔗 Link: {event['url']}\n")
+                        schedule.add('\n')
                     except Exception:
                         pass
             else:
-                context += "  ✅ No upcoming deadlines or events in the next 2 weeks.\n"
+                schedule.add("  ✅ No upcoming deadlines or events in the next 2 weeks.\n")
            
-            context += '\n'
-       
-        # MODULES & CONTENT FETCHING - Only if target course exists
-        if target_course and any(word in query_lower for word in ['module', 'week', 'material', 'content', 'lecture', 'learn',
-                                                  'topic', 'summarize', 'summary', 'pdf', 'file', 'video']):
-            context += '📚 DETAILED COURSE CONTENT:\n'
-            
-            courses_to_check = [target_course]
-            
-            for course in courses_to_check:
-                try:
-                    context += f"\n{'='*60}\n"
-                    context += f"📖 COURSE: {course['name']} (Code: {course.get('course_code', 'N/A')})\n"
-                    context += f"{'='*60}\n\n"
-                    
-                    modules_response = requests.get(
-                        f"{canvas_url}/courses/{course['id']}/modules?include[]=items",
-                        headers=headers,
-                        timeout=10
-                    )
-                    if modules_response.status_code != 200:
-                        print(f"Failed to fetch modules for course {course.get('id')}: {modules_response.status_code}")
-                        context += f"  ⚠️ Could not fetch modules for this course.\n\n"
-                        continue
-                    modules = modules_response.json()
-                   
-                    if isinstance(modules, list) and modules:
-                        print(f"📋 Available modules in {course['name']}:")
-                        for mod in modules:
-                            print(f"   - {mod.get('name', 'Unknown')}")
-                        
-                        target_modules = modules
-                        if 'week' in query_lower or 'module' in query_lower:
-                            number_match = re.search(r'(?:week|module|wk|mod)\s*(\d+)', query_lower)
-                            if number_match:
-                                number = number_match.group(1)
-                                target_modules = []
-                                
-                                for m in modules:
-                                    module_name_lower = m.get('name', '').lower()
-                                    if any([
-                                        f'week {number}' in module_name_lower,
-                                        f'week{number}' in module_name_lower,
-                                        f'week-{number}' in module_name_lower,
-                                        f'wk {number}' in module_name_lower,
-                                        f'wk{number}' in module_name_lower,
-                                        f'module {number}' in module_name_lower,
-                                        f'mod {number}' in module_name_lower,
-                                        f'unit {number}' in module_name_lower,
-                                        f'lesson {number}' in module_name_lower,
-                                        f'chapter {number}' in module_name_lower,
-                                        module_name_lower.startswith(f'{number} -'),
-                                        module_name_lower.startswith(f'{number}.'),
-                                        module_name_lower.startswith(f'{number}:')
-                                    ]):
-                                        target_modules.append(m)
-                                        print(f"✅ Matched module: {m.get('name')}")
-                                
-                                if target_modules:
-                                    print(f"🔍 Filtering for {number_match.group(0)}, found {len(target_modules)} modules")
-                                    context += f"  🔍 Showing content for {number_match.group(0).title()}\n\n"
-                                else:
-                                    print(f"⚠️ No modules found matching {number_match.group(0)}")
-                                    context += f"  ⚠️ {number_match.group(0).title()} not found. Available modules:\n"
-                                    for mod in modules[:15]:
-                                        context += f"     - {mod.get('name', 'Unknown')}\n"
-                                    context += "\n"
-                                    target_modules = modules[:5]
-                        
-                        if not target_modules:
-                            context += f"  ℹ️ No modules to display.\n\n"
-                            continue
-                       
-                        for module in target_modules[:8]:
-                            module_name = module.get('name', 'Unknown Module')
-                            module_id = module.get('id', 'N/A')
-                            context += f"  📂 {module_name} (Module ID: {module_id})\n"
-                           
-                            items = module.get('items', [])
-                            
-                            if not items:
-                                context += f"    ℹ️ No items in this module\n\n"
-                                continue
-                                
-                            context += f"    📋 Found {len(items)} items in this module\n\n"
-                            
-                            for item in items[:20]:
-                                item_title = item.get('title', 'Unknown')
-                                item_type = item.get('type', 'Unknown')
-                                item_url = item.get('html_url', '') or item.get('url', '')
-                               
-                                context += f"    {'─'*50}\n"
-                                context += f"    📌 {item_title} ({item_type})\n"
-                                
-                                if item_type == 'Page':
-                                    page_url = item.get('url') or item.get('html_url')
-                                    if page_url:
-                                        print(f"📄 Fetching page: {item_title}")
-                                        page_content = get_page_content(course_id=course['id'], page_url=page_url, headers=headers, canvas_url=canvas_url, user_id=user_id)
-                                        if page_content and page_content.get('content'):
-                                            context += f"\n    📄 PAGE CONTENT:\n"
-                                            context += f"    {'-'*50}\n"
-                                            context += f"{page_content['content']}\n"
-                                            context += f"    {'-'*50}\n"
-                                            
-                                            if page_content.get('urls'):
-                                                context += f"    🔗 Embedded links: {', '.join(page_content['urls'][:10])}\n"
-                                        else:
-                                            context += f"    ⚠️ Could not fetch page content\n"
-                                        
-                                        if item_url:
-                                            context += f"    🔗 Page URL: {item_url}\n"
-                                
-                                elif item_type == 'File':
-                                    file_id = item.get('content_id')
-                                    if file_id:
-                                        try:
-                                            file_response = requests.get(
-                                                f"{canvas_url}/files/{file_id}",
-                                                headers=headers,
-                                                timeout=10
-                                            )
-                                            if file_response.status_code == 200:
-                                                file_data = file_response.json()
-                                                file_name = file_data.get('filename', '')
-                                                file_url = file_data.get('url', '')
-                                                mime_type = file_data.get('content-type', '')
-                                               
-                                                context += f"    📎 File: {file_name}\n"
-                                                context += f"    🔗 Download: {item_url}\n"
-                                               
-                                                if 'pdf' in mime_type.lower() or file_name.lower().endswith('.pdf'):
-                                                    context += f"\n    📄 EXTRACTING PDF CONTENT...\n"
-                                                    pdf_text = extract_pdf_text(pdf_url=file_url, headers=headers, user_id=user_id)
-                                                    if pdf_text:
-                                                        context += f"    {'-'*50}\n"
-                                                        context += f"    PDF CONTENT:\n"
-                                                        context += f"{pdf_text}\n"
-                                                        context += f"    {'-'*50}\n"
-                                                    else:
-                                                        context += f"    ⚠️ Could not extract PDF text\n"
-                                        except Exception as e:
-                                            context += f"    ⚠️ Error processing file: {str(e)}\n"
-                                
-                                elif item_type == 'ExternalUrl':
-                                    external_url = item.get('external_url', item_url)
-                                    context += f"    🔗 Link: {external_url}\n"
-                                    
-                                    if external_url and ('youtube.com' in external_url or 'youtu.be' in external_url):
-                                        context += f"\n    🎥 FETCHING VIDEO TRANSCRIPT...\n"
-                                        transcript = get_video_transcript(video_url=external_url, user_id=user_id)
-                                        if transcript:
-                                            context += f"    {'-'*50}\n"
-                                            context += f"    VIDEO TRANSCRIPT:\n"
-                                            context += f"{transcript[:25000]}\n"
-                                            context += f"    {'-'*50}\n"
-                                        else:
-                                            context += f"    ⚠️ Transcript not available\n"
-                                
-                                elif item_type == 'Assignment':
-                                    assignment_id = item.get('content_id')
-                                    if assignment_id:
-                                        try:
-                                            assign_response = requests.get(
-                                                f"{canvas_url}/courses/{course['id']}/assignments/{assignment_id}",
-                                                headers=headers,
-                                                timeout=10
-                                            )
-                                            if assign_response.status_code == 200:
-                                                assign_data = assign_response.json()
-                                                description = assign_data.get('description', '')
-                                                due_at = assign_data.get('due_at', 'No due date')
-                                                points = assign_data.get('points_possible', 'N/A')
-                                                
-                                                context += f"    📝 Assignment Details:\n"
-                                                context += f"       Due: {due_at}\n"
-                                                context += f"       Points: {points}\n"
-                                                context += f"    🔗 URL: {item_url}\n"
-                                                
-                                                if description:
-                                                    clean_desc = re.sub('<[^<]+?>', '', description)
-                                                    clean_desc = re.sub(r'\s+', ' ', clean_desc).strip()
-                                                    context += f"\n    📋 ASSIGNMENT DESCRIPTION:\n"
-                                                    context += f"    {'-'*50}\n"
-                                                    context += f"{clean_desc[:10000]}\n"
-                                                    context += f"    {'-'*50}\n"
-                                        except Exception as e:
-                                            context += f"    ⚠️ Could not fetch assignment details\n"
-                                    else:
-                                        context += f"    🔗 URL: {item_url}\n"
-                                
-                                elif item_type == 'ExternalTool':
-                                    context += f"    🔧 External Tool\n"
-                                    context += f"    🔗 Link: {item_url}\n"
-                                
-                                elif item_type == 'Quiz':
-                                    context += f"    📝 Quiz\n"
-                                    context += f"    🔗 Link: {item_url}\n"
-                                
-                                elif item_type == 'Discussion':
-                                    context += f"    💬 Discussion\n"
-                                    context += f"    🔗 Link: {item_url}\n"
-                                
-                                else:
-                                    context += f"    🔗 URL: {item_url}\n"
-                                
-                                context += "\n"
-                    
-                    else:
-                        context += f"  ℹ️ No modules found for this course.\n\n"
-                        
-                except Exception as e:
-                    print(f"Error fetching content: {str(e)}")
-                    context += f"  ⚠️ Error: {str(e)}\n\n"
-            
-            context += '\n'
+            schedule.add('\n')
        
         # GRADES & SUBMISSIONS - Only if target course exists
         if target_course and any(word in query_lower for word in ['grade', 'score', 'mark', 'submission', 'submitted', 'progress']):
-            context += '📊 YOUR GRADES & SUBMISSIONS:\n'
+            grades.add('📊 YOUR GRADES & SUBMISSIONS:\n')
             courses_to_check = [target_course]
            
             for course in courses_to_check:
                 grades_data = get_grades_info(course_id=course['id'], headers=headers, canvas_url=canvas_url, user_id=user_id)
                 if grades_data:
-                    context += f"\n{course['name']}:\n"
+                    grades.add(f"\n{course['name']}:\n")
                     for assignment in grades_data[:10]:
                         name = assignment.get('name', 'Unknown')
                         points = assignment.get('points_possible', 'N/A')
@@ -1064,36 +1250,33 @@ def get_canvas_context(query, canvas_token, canvas_url, user_id):
                             score = submission.get('score', 'Not graded')
                             status = submission.get('workflow_state', 'not submitted')
                            
-                            context += f"  📝 {name}\n"
-                            context += f"     Score: {score}/{points} | Status: {status}\n"
+                            grades.add(f"  📝 {name}\n")
+                            grades.add(f"     Score: {score}/{points} | Status: {status}\n")
                         else:
-                            context += f"  📝 {name} (Not submitted, {points} points)\n"
-            context += '\n'
+                            grades.add(f"  📝 {name} (Not submitted, {points} points)\n")
+            grades.add('\n')
+
+        # Whatever module items are ready by the deadline go into the context
+        if wants_content:
+            if module_jobs:
+                finish_module_content(query, target_course, canvas_url, module_jobs, content, deadline)
+            content.add('\n')
        
+        context = builder.build()
+        builder.log_usage()
         return context
    
     except Exception as e:
         return f"Error fetching Canvas data: {str(e)}"
 
 
-def call_gemini(context, api_key, conversation_history):
-    """Enhanced AI assistant with grade calculation support"""
-    model_name = 'gemini-1.5-pro'
-   
-    if os.path.exists('gemini_model.txt'):
-        try:
-            with open('gemini_model.txt', 'r') as f:
-                saved_model = f.read().strip()
-                if saved_model:
-                    model_name = saved_model
-                    print(f"📖 Using saved model: {model_name}")
-        except Exception as e:
-            print(f"⚠️ Error reading model file: {e}")
+# Static instructions, built once. They always go first and never change
+# between turns, so Gemini can serve them from its prompt cache (or from a
+# cachedContents resource when GEMINI_CONTEXT_CACHING is on); the Canvas data
+# is sent separately with the latest message.
+SYSTEM_PROMPT = """You are a friendly, helpful Canvas Learning Assistant that creates EASY-TO-READ, STUDENT-FRIENDLY study materials and helps with grade calculations.
 
-    system_prompt = f"""You are a friendly, helpful Canvas Learning Assistant that creates EASY-TO-READ, STUDENT-FRIENDLY study materials and helps with grade calculations.
-
-STUDENT'S CANVAS DATA:
-{context}
+The student's Canvas data for each question is attached to their latest message, under "STUDENT'S CANVAS DATA:".
 
 CRITICAL INSTRUCTIONS:
 
@@ -1299,20 +1482,56 @@ CRITICAL INSTRUCTIONS:
 
 REMEMBER: Your goal is to make learning EASY and ENJOYABLE using the Pareto Principle (focus on the 20% that matters most), provide ALL clickable resource links, and help students understand exactly what they need to achieve their grade goals. Always be encouraging and supportive!"""
 
-    url = f'https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}'
-   
+SYSTEM_INSTRUCTION = {'parts': [{'text': SYSTEM_PROMPT}]}
+
+
+def with_canvas_data(conversation_history, context):
+    """Copy of the history with the Canvas data attached to the latest user turn"""
+    data_part = {'text': f"STUDENT'S CANVAS DATA:\n{context}\n"}
+    history = list(conversation_history)
+    for i in range(len(history) - 1, -1, -1):
+        if history[i].get('role', 'user') == 'user':
+            history[i] = {**history[i], 'parts': [data_part] + list(history[i].get('parts', []))}
+            return history
+    return history + [{'role': 'user', 'parts': [data_part]}]
+
+
+def build_gemini_payload(context, conversation_history, cached_content=None):
+    """Request body shared by the blocking and streaming Gemini calls"""
     payload = {
-        'contents': conversation_history,
-        'system_instruction': {
-            'parts': [{'text': system_prompt}]
-        },
+        'contents': with_canvas_data(conversation_history, context),
         'generationConfig': {
             'temperature': 0.4,
             'maxOutputTokens': 15000
         }
     }
+    if cached_content:
+        payload['cachedContent'] = cached_content
+    else:
+        payload['system_instruction'] = SYSTEM_INSTRUCTION
+    return payload
+
+
+def gemini_payload_for(context, conversation_history, api_key, model_name):
+    """
+    Payload factory for post_with_fallback. Cached contents are per model, so
+    only the selected model uses one; fallback candidates may not accept the
+    request at all and get the prompt inline rather than a cache of their own.
+    """
+    selected_model = model_registry.fallback_chain(model_name)[0]
+
+    def build(candidate):
+        use_cache = GEMINI_CONTEXT_CACHING and candidate == selected_model
+        cached_content = get_cached_content(api_key, candidate, SYSTEM_PROMPT) if use_cache else None
+        return build_gemini_payload(context, conversation_history, cached_content)
+    return build
+
+
+def call_gemini(context, api_key, conversation_history, model_name=None):
+    """Enhanced AI assistant with grade calculation support"""
+    payload = gemini_payload_for(context, conversation_history, api_key, model_name)
    
-    response = requests.post(url, json=payload, timeout=45)
+    response, _ = post_with_fallback(model_name, 'generateContent', api_key, payload, timeout=45)
    
     if response.status_code != 200:
         raise Exception(f"Gemini API error: {response.text}")
@@ -1321,5 +1540,41 @@ REMEMBER: Your goal is to make learning EASY and ENJOYABLE using the Pareto Prin
     return data['candidates'][0]['content']['parts'][0]['text']
 
 
+def stream_gemini(context, api_key, conversation_history, model_name=None):
+    """Yield the answer text as Gemini generates it (streamGenerateContent over SSE)"""
+    payload = gemini_payload_for(context, conversation_history, api_key, model_name)
+
+    # Fallback only happens before the first chunk; a stream that fails midway is not retried
+    response, _ = post_with_fallback(
+        model_name, 'streamGenerateContent', api_key, payload,
+        params={'alt': 'sse'}, timeout=GEMINI_STREAM_TIMEOUT, stream=True
+    )
+    with response:
+        if response.status_code != 200:
+            raise Exception(f"Gemini API error: {response.text}")
+
+        # text/event-stream has no charset, and requests would otherwise assume latin-1
+        response.encoding = 'utf-8'
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            chunk = json.loads(line[len('data:'):].strip())
+            for candidate in chunk.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+
+
+def relay_gemini_stream(context, api_key, conversation_history, model_name=None):
+    """Server-sent events for /api/chat: a data event per text chunk, then 'done' or 'error'"""
+    try:
+        for text in stream_gemini(context, api_key, conversation_history, model_name):
+            yield f"data: {json.dumps({'text': text})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+    except Exception as e:
+        print(f"❌ Gemini stream failed: {str(e)}")
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
\ No newline at end of file
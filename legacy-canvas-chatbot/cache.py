@@ -1,67 +1,659 @@
 import os
+import sys
+import glob
 import json
 import time
+import zlib
+import hashlib
+import inspect
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
+from cache_backends import JSONFileBackend, SQLiteBackend
+
+try:
+    import fcntl
+except ImportError:  # Windows - cross-process single-flight is unavailable
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # optional - zlib is used when zstandard isn't installed
+    zstandard = None
+
 CACHE_DIR = 'cache'
 CACHE_DURATION = 3600  # 1 hour
 
+# Storage backend behind the memory tier: 'sqlite' (default) or 'json' (one file per key)
+CACHE_BACKEND = 'sqlite'
+CACHE_DB_PATH = os.path.join(CACHE_DIR, 'cache.sqlite3')
+
+# Per-prefix TTLs in seconds - prefixes not listed here use CACHE_DURATION
+CACHE_TTLS = {
+    'grades_info': 900,
+    'calendar_events': 900,
+    'upcoming_assignments': 900,
+    'page_content': 3600,
+    'pdf_text': 6 * 3600,
+    'video_transcript': 24 * 3600,
+    'artifact': 7 * 24 * 3600,
+    'courses': 600,
+    'gemini_model': 3600,
+}
+
+# Stale-while-revalidate grace windows in seconds. Within the window after its TTL
+# an entry is still served straight away while a background refresh replaces it.
+# Prefixes not listed here expire hard at their TTL.
+CACHE_STALE_GRACE = {
+    'grades_info': 300,
+    'calendar_events': 300,
+    'upcoming_assignments': 300,
+    'courses': 600,
+    'page_content': 3600,
+    'pdf_text': 7 * 24 * 3600,
+    'video_transcript': 7 * 24 * 3600,
+    'artifact': 7 * 24 * 3600,
+}
+
+# Shared, content-addressed entries (PDF text, transcripts) are keyed under this
+# prefix. They are identified by resource id + version, so they are never stale
+# in the usual sense and can be kept much longer than per-user data.
+ARTIFACT_PREFIX = 'artifact'
+
+# Limits for the in-process LRU tier that sits in front of the storage backend
+MEMORY_CACHE_MAX_ENTRIES = 1024
+MEMORY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64 MB
+
+# Arguments that must never end up in a cache key (auth headers carry the bearer token)
+SECRET_ARGS = {'headers', 'canvas_token', 'api_key', 'gemini_key'}
+
+# Single-flight: concurrent misses for the same key wait this long (seconds) on the
+# in-flight computation before giving up and computing on their own
+SINGLE_FLIGHT_TIMEOUT = 60
+
+# Also coalesce across worker processes with a lock file per key (POSIX only).
+# Only worth enabling when running several workers over the same cache dir.
+CROSS_PROCESS_SINGLE_FLIGHT = False
+LOCK_DIR = os.path.join(CACHE_DIR, 'locks')
+
+# Transparent compression for large-text prefixes: prefix -> compression level.
+# zstd is used when the zstandard package is installed, zlib otherwise (zlib
+# levels are capped at 9). Payloads under CACHE_COMPRESSION_MIN_BYTES stay raw.
+CACHE_COMPRESSION = {
+    'page_content': 3,
+    'pdf_text': 3,
+    'video_transcript': 3,
+    'artifact': 3,
+}
+CACHE_COMPRESSION_MIN_BYTES = 2048
+
+# Stored payloads start with one of these markers; raw JSON never starts with a NUL byte
+_ZSTD_MARKER = b'\x00zs'
+_ZLIB_MARKER = b'\x00zl'
+
+# Disk budget for the storage backend, overall and per prefix (bytes). The
+# janitor evicts by CACHE_EVICTION_POLICY ('lru' or 'lfu') until both fit.
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB
+CACHE_PREFIX_MAX_BYTES = {
+    'artifact': 1024 * 1024 * 1024,
+    'pdf_text': 512 * 1024 * 1024,
+    'video_transcript': 256 * 1024 * 1024,
+    'page_content': 256 * 1024 * 1024,
+}
+CACHE_EVICTION_POLICY = 'lru'
+
+# How often the janitor thread purges expired entries and enforces the budgets
+CACHE_JANITOR_INTERVAL = 300
+
 if not os.path.exists(CACHE_DIR):
     os.makedirs(CACHE_DIR)
 
-def get_cache_path(key):
-    return os.path.join(CACHE_DIR, f'{key}.json')
 
-def is_cache_valid(filepath):
-    if not os.path.exists(filepath):
-        return False
-    
-    mod_time = os.path.getmtime(filepath)
-    return (time.time() - mod_time) < CACHE_DURATION
+class MemoryCache:
+    """Thread-safe LRU of decoded cache values, bounded by entry count and bytes"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, stored_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_entry(self, key):
+        """Return (value, stored_at) for a live entry, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, stored_at, size, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._bytes -= size
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, stored_at
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def set(self, key, value, size, expires_at, stored_at=None):
+        # Values larger than the whole tier only live on disk; drop any older
+        # value for the key so it isn't served in place of the new one
+        if size > self.max_bytes:
+            self.delete(key)
+            return
+
+        if stored_at is None:
+            stored_at = time.time()
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+            self._entries[key] = (expires_at, stored_at, size, value)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def create_backend(name=CACHE_BACKEND):
+    if name == 'sqlite':
+        return SQLiteBackend(CACHE_DB_PATH)
+    if name == 'json':
+        return JSONFileBackend(CACHE_DIR, group_prefixes=(ARTIFACT_PREFIX,))
+    raise ValueError(f"Unknown cache backend: {name}")
+
+
+backend = create_backend()
+memory_cache = MemoryCache(MEMORY_CACHE_MAX_ENTRIES, MEMORY_CACHE_MAX_BYTES)
+_disk_stats = {'hits': 0, 'misses': 0}
+
+# Background refreshes run here; _refreshing dedupes them so only one runs per key
+_refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='cache-refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
 
-def get_cached_data(key):
-    filepath = get_cache_path(key)
-    if is_cache_valid(filepath):
+_in_flight = {}  # key -> _Flight
+_in_flight_lock = threading.Lock()
+
+# Access stats for LRU/LFU are buffered here and flushed by the janitor, so
+# request threads never write to the backend just because they read from it
+_accesses = {}  # key -> (last_access, hit_count)
+_accesses_lock = threading.Lock()
+
+_janitor_thread = None
+_janitor_lock = threading.Lock()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def get_ttl(key_prefix):
+    return CACHE_TTLS.get(key_prefix, CACHE_DURATION)
+
+
+def get_stale_grace(key_prefix):
+    return CACHE_STALE_GRACE.get(key_prefix, 0)
+
+
+def get_max_age(key_prefix):
+    """Hard expiry for a prefix - its TTL plus any stale grace"""
+    if key_prefix.startswith(ARTIFACT_PREFIX):
+        key_prefix = ARTIFACT_PREFIX
+    return get_ttl(key_prefix) + get_stale_grace(key_prefix)
+
+
+def encode_payload(data, key_prefix=None):
+    """Serialise data for the backend; returns (payload, uncompressed_size)"""
+    raw = json.dumps(data).encode('utf-8')
+    level = CACHE_COMPRESSION.get(key_prefix)
+    if level is None or len(raw) < CACHE_COMPRESSION_MIN_BYTES:
+        return raw, len(raw)
+
+    if zstandard is not None:
+        payload = _ZSTD_MARKER + zstandard.ZstdCompressor(level=level).compress(raw)
+    else:
+        payload = _ZLIB_MARKER + zlib.compress(raw, min(level, 9))
+
+    # Keep whichever is smaller - already-dense data can grow when compressed
+    return (payload if len(payload) < len(raw) else raw), len(raw)
+
+
+def decode_payload(payload):
+    """
+    Inverse of encode_payload: returns (data, uncompressed_size). Raises
+    ValueError for unreadable payloads.
+    """
+    if payload.startswith(_ZSTD_MARKER):
+        if zstandard is None:
+            raise ValueError('zstd-compressed cache entry but zstandard is not installed')
+        payload = zstandard.ZstdDecompressor().decompress(payload[len(_ZSTD_MARKER):])
+    elif payload.startswith(_ZLIB_MARKER):
         try:
-            with open(filepath, 'r') as f:
-                return json.load(f)
-        except (IOError, json.JSONDecodeError):
-            return None
-    return None
+            payload = zlib.decompress(payload[len(_ZLIB_MARKER):])
+        except zlib.error as e:
+            raise ValueError(str(e))
+    return json.loads(payload), len(payload)
+
+
+def _record_access(key):
+    with _accesses_lock:
+        _, count = _accesses.get(key, (0, 0))
+        _accesses[key] = (time.time(), count + 1)
+
+
+def get_cached_entry(key, key_prefix=None, allow_stale=False):
+    """
+    Return (data, stored_at) for a valid entry, or (None, None) on a miss.
+    With allow_stale, entries still inside their prefix's grace window count too.
+    """
+    ttl = get_ttl(key_prefix)
+    grace = get_stale_grace(key_prefix)
+    max_age = ttl + grace if allow_stale else ttl
+
+    # Memory tier first - a hit here never touches the filesystem
+    entry = memory_cache.get_entry(key)
+    if entry is not None and time.time() - entry[1] < max_age:
+        _record_access(key)
+        return entry
+
+    try:
+        record = backend.get(key)
+    except Exception as e:
+        print(f"CACHE READ FAILED: for key {key}: {str(e)}")
+        record = None
+
+    if record is not None and time.time() - record[1] < max_age:
+        payload, stored_at = record
+        try:
+            data, raw_size = decode_payload(payload)
+        except Exception:
+            _disk_stats['misses'] += 1
+            return None, None
+
+        # Promote to memory for whatever is left of the entry's lifetime, sized
+        # like a fresh write so compressed entries don't undercount the budget
+        memory_cache.set(key, data, raw_size, stored_at + ttl + grace, stored_at)
+        _disk_stats['hits'] += 1
+        _record_access(key)
+        return data, stored_at
+
+    _disk_stats['misses'] += 1
+    return None, None
+
+
+def get_cached_data(key, key_prefix=None):
+    return get_cached_entry(key, key_prefix)[0]
+
+
+def cache_data(key, data, key_prefix=None):
+    # Write-through: memory tier and storage backend are updated together
+    payload, raw_size = encode_payload(data, key_prefix)
+    stored_at = time.time()
+    expires_at = stored_at + get_ttl(key_prefix) + get_stale_grace(key_prefix)
+    memory_cache.set(key, data, raw_size, expires_at, stored_at)
 
-def cache_data(key, data):
-    filepath = get_cache_path(key)
     try:
-        with open(filepath, 'w') as f:
-            json.dump(data, f)
-    except IOError:
-        pass
+        backend.set(key, key_prefix, payload, stored_at, expires_at)
+    except Exception as e:
+        print(f"CACHE WRITE FAILED: for key {key}: {str(e)}")
 
-def cached(key_prefix):
+
+class Uncached:
+    """
+    Return Uncached(value) from a @cached function to hand value to the caller
+    without storing it - for partial results (a timed-out scan, a PDF cut short
+    by a limit) that would otherwise be served to everyone until they expire.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+def refresh_in_background(key, key_prefix, func, *args, **kwargs):
+    """Recompute an entry off the request thread; a no-op if one is already running"""
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            result = func(*args, **kwargs)
+            if result and not isinstance(result, Uncached):
+                cache_data(key, result, key_prefix)
+        except Exception as e:
+            print(f"CACHE REFRESH FAILED: for key {key}: {str(e)}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    print(f"CACHE REFRESH: for key {key}")
+    _refresh_executor.submit(refresh)
+
+
+@contextmanager
+def _process_lock(key):
+    """Hold an exclusive lock file for key; yields False if it couldn't be taken in time"""
+    if not CROSS_PROCESS_SINGLE_FLIGHT or fcntl is None:
+        yield False
+        return
+
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    lock_path = os.path.join(LOCK_DIR, f'{key}.lock')
+    deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT
+    while True:
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            if time.monotonic() >= deadline:
+                yield False
+                return
+            time.sleep(0.05)
+            continue
+
+        # The janitor may have removed the file between open and flock; a
+        # lock on an unlinked file excludes nobody, so start over
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except OSError:
+            pass
+        lock_file.close()
+
+    with lock_file:
+        # flock never touches the file, so mark it as in use for the janitor
+        os.utime(lock_path)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _compute_and_store(key, key_prefix, compute):
+    with _process_lock(key) as locked:
+        if locked:
+            # Another worker may have filled the entry while we waited for the lock
+            data = get_cached_data(key, key_prefix)
+            if data:
+                return data
+
+        result = compute()
+        if isinstance(result, Uncached):
+            print(f"CACHE SKIP: partial result for key {key}")
+            return result.value
+        if result:
+            cache_data(key, result, key_prefix)
+        return result
+
+
+def compute_once(key, key_prefix, compute):
+    """
+    Single-flight computation of a missed cache entry.
+
+    The first caller for a key runs compute() and stores the result; callers
+    arriving while it is in flight wait for that result instead of starting
+    their own fetch. If the leader fails or takes longer than
+    SINGLE_FLIGHT_TIMEOUT, waiters fall back to computing it themselves.
+    """
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _in_flight[key] = flight
+
+    if not leader:
+        print(f"CACHE WAIT: for key {key}")
+        if flight.done.wait(SINGLE_FLIGHT_TIMEOUT) and flight.error is None:
+            return flight.result
+        return _compute_and_store(key, key_prefix, compute)
+
+    try:
+        flight.result = _compute_and_store(key, key_prefix, compute)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+        flight.done.set()
+
+
+def get_cache_stats():
+    return {
+        'memory': memory_cache.stats(),
+        'disk': dict(_disk_stats),
+    }
+
+
+def run_janitor_pass():
+    """Flush access stats, purge expired entries and enforce the byte budgets"""
+    with _accesses_lock:
+        accesses = dict(_accesses)
+        _accesses.clear()
+    backend.touch(accesses)
+
+    purged = backend.purge_expired(get_max_age)
+    evicted = 0
+    for prefix, max_bytes in CACHE_PREFIX_MAX_BYTES.items():
+        evicted += backend.evict(max_bytes, prefix=prefix, policy=CACHE_EVICTION_POLICY)
+    evicted += backend.evict(CACHE_MAX_BYTES, policy=CACHE_EVICTION_POLICY)
+
+    # Lock files are only needed while a fetch is in flight. One that is old
+    # is removed while holding its lock, so a fetch in progress is never hit.
+    for path in glob.glob(os.path.join(LOCK_DIR, '*.lock')):
+        try:
+            if time.time() - os.path.getmtime(path) <= SINGLE_FLIGHT_TIMEOUT * 10:
+                continue
+            with open(path, 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+        except OSError:
+            pass
+
+    if purged or evicted:
+        print(f"CACHE JANITOR: purged {purged} expired, evicted {evicted} over budget")
+    return purged, evicted
+
+
+def _janitor_loop():
+    while True:
+        time.sleep(CACHE_JANITOR_INTERVAL)
+        try:
+            run_janitor_pass()
+        except Exception as e:
+            print(f"CACHE JANITOR FAILED: {str(e)}")
+
+
+def start_janitor():
+    """Start the background janitor thread for this process (idempotent)"""
+    global _janitor_thread
+    with _janitor_lock:
+        if _janitor_thread is None or not _janitor_thread.is_alive():
+            _janitor_thread = threading.Thread(target=_janitor_loop, name='cache-janitor', daemon=True)
+            _janitor_thread.start()
+
+
+def _canonical_value(value):
+    """Return a JSON-safe form of a key argument, or None if it can't be keyed"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (tuple, list)) and all(
+            v is None or isinstance(v, (str, int, float, bool)) for v in value):
+        return list(value)
+    return None
+
+
+def make_cache_key(key_prefix, key_parts):
+    """Hash the canonicalised key parts into a fixed-length, filesystem-safe key"""
+    canonical = json.dumps(key_parts, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+    return f"{key_prefix}_{digest}"
+
+
+def cached(key_prefix, key_args=(), per_user=True, content_id=None, refresh_after=None, call_only_args=()):
+    """
+    Cache a function's result under a key built from its arguments.
+
+    key_args names the arguments that identify the resource (e.g. page_url);
+    per_user=False drops user_id so the entry is shared across users.
+    Secret or unhashable arguments such as the headers dict are never keyed.
+
+    content_id, if given, is called with the call's arguments and may return a
+    stable identity for the underlying content (e.g. Canvas file id + version).
+    When it does, the result lives in the shared artifact store and is reused
+    by every user; otherwise the normal key is used.
+
+    refresh_after (seconds) enables refresh-ahead: a hit older than this is
+    still returned immediately, and a background refresh is scheduled.
+    Entries past their TTL but inside CACHE_STALE_GRACE are handled the same way.
+
+    call_only_args names arguments that only shape the caller's own call, such
+    as a request deadline. Background refreshes run with their defaults.
+
+    Falsy results are never stored; wrap a partial result in Uncached to
+    return it without storing it.
+    """
     def decorator(func):
+        signature = inspect.signature(func)
+        key_names = [name for name in key_args if name not in SECRET_ARGS]
+        if per_user and 'user_id' in signature.parameters and 'user_id' not in key_names:
+            key_names.append('user_id')
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Create a unique key for the function call
-            # This is a simple example; more complex key generation might be needed
-            # based on function arguments.
-            user_id = kwargs.get('user_id', 'global')
-            key = f"{key_prefix}_{user_id}"
-            
-            # For functions that take course_id
-            if 'course_id' in kwargs:
-                key += f"_course_{kwargs['course_id']}"
-
-            cached_result = get_cached_data(key)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+
+            artifact_id = content_id(**bound.arguments) if content_id else None
+            if artifact_id:
+                key = make_cache_key(f"{ARTIFACT_PREFIX}_{key_prefix}", {'content_id': artifact_id})
+                ttl_prefix = ARTIFACT_PREFIX
+            else:
+                key_parts = {}
+                for name in key_names:
+                    value = _canonical_value(bound.arguments.get(name))
+                    if value is not None:
+                        key_parts[name] = value
+                key = make_cache_key(key_prefix, key_parts)
+                ttl_prefix = key_prefix
+
+            cached_result, stored_at = get_cached_entry(key, ttl_prefix, allow_stale=True)
             if cached_result:
-                print(f"CACHE HIT: for key {key}")
+                refresh_arguments = {name: value for name, value in bound.arguments.items()
+                                     if name not in call_only_args}
+                age = time.time() - stored_at
+                if age >= get_ttl(ttl_prefix):
+                    print(f"CACHE STALE HIT: for key {key}")
+                    refresh_in_background(key, ttl_prefix, func, **refresh_arguments)
+                else:
+                    print(f"CACHE HIT: for key {key}")
+                    if refresh_after is not None and age > refresh_after:
+                        refresh_in_background(key, ttl_prefix, func, **refresh_arguments)
                 return cached_result
 
             print(f"CACHE MISS: for key {key}")
-            result = func(*args, **kwargs)
-            
-            if result:
-                cache_data(key, result)
-            
-            return result
+            return compute_once(key, ttl_prefix, lambda: func(*args, **kwargs))
         return wrapper
     return decorator
+
+
+def _format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} {unit}"
+        size /= 1024
+
+
+def measure_compression(prefix, sample_size=50):
+    """Sample stored entries of a prefix: (stored bytes, raw bytes, avg decode ms)"""
+    stored_bytes = raw_bytes = 0
+    decode_seconds = 0.0
+    samples = backend.sample(prefix, sample_size)
+    for payload in samples:
+        started = time.perf_counter()
+        _, raw_size = decode_payload(payload)
+        decode_seconds += time.perf_counter() - started
+        stored_bytes += len(payload)
+        raw_bytes += raw_size
+    avg_decode_ms = (decode_seconds / len(samples) * 1000) if samples else 0.0
+    return stored_bytes, raw_bytes, avg_decode_ms
+
+
+def main(argv):
+    """Command line maintenance: python cache.py report|purge|compact"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect and maintain the Canvas chatbot cache')
+    parser.add_argument('command', choices=['report', 'purge', 'compact'])
+    args = parser.parse_args(argv)
+
+    if args.command in ('purge', 'compact'):
+        purged, evicted = run_janitor_pass()
+        print(f"Purged {purged} expired entries, evicted {evicted} over budget")
+    if args.command == 'compact':
+        backend.compact()
+        print("Compacted cache storage")
+
+    usage = backend.usage()
+    total_entries = sum(u['entries'] for u in usage.values())
+    total_bytes = sum(u['bytes'] for u in usage.values())
+    print(f"{'prefix':<28}{'entries':>10}{'size':>14}{'budget':>14}{'ratio':>8}{'decode':>12}")
+    for prefix in sorted(usage, key=lambda p: -usage[p]['bytes']):
+        budget = CACHE_PREFIX_MAX_BYTES.get(prefix)
+        stored_bytes, raw_bytes, avg_decode_ms = measure_compression(prefix)
+        ratio = f"{raw_bytes / stored_bytes:.2f}x" if stored_bytes else '-'
+        print(f"{prefix:<28}{usage[prefix]['entries']:>10}{_format_bytes(usage[prefix]['bytes']):>14}"
+              f"{_format_bytes(budget) if budget else '-':>14}{ratio:>8}{avg_decode_ms:>9.2f} ms")
+    print(f"{'total':<28}{total_entries:>10}{_format_bytes(total_bytes):>14}{_format_bytes(CACHE_MAX_BYTES):>14}")
+    print(f"Compression: {'zstd' if zstandard is not None else 'zlib'} (ratio/decode sampled from up to 50 entries per prefix)")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
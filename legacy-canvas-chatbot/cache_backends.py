@@ -0,0 +1,286 @@
+import os
+import glob
+import time
+import sqlite3
+import tempfile
+import threading
+
+
+class JSONFileBackend:
+    """
+    One file per key in a flat directory - the original cache layout.
+
+    Writes go to a temp file first and are renamed into place, so a crash
+    mid-write can never leave a truncated entry behind. The file's mtime is
+    the entry's stored_at time.
+
+    An entry's prefix is read back from its file name; names under one of
+    group_prefixes (e.g. artifact_pdf_text_...) count as that prefix, the
+    way the SQLite backend stores them.
+    """
+
+    def __init__(self, cache_dir, group_prefixes=()):
+        self.cache_dir = cache_dir
+        self.group_prefixes = tuple(group_prefixes)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        """Return (payload, stored_at) or None"""
+        path = self._path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                return f.read(), stored_at
+        except OSError:
+            return None
+
+    def set(self, key, key_prefix, payload, stored_at, expires_at):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.utime(tmp_path, (stored_at, stored_at))
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _prefix_of(self, key):
+        prefix = key.rsplit('_', 1)[0]
+        for group in self.group_prefixes:
+            if prefix == group or prefix.startswith(f'{group}_'):
+                return group
+        return prefix
+
+    def _entries(self):
+        """Yield (path, prefix, size, stored_at) for every entry file"""
+        for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            key = os.path.basename(path)[:-len('.json')]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, self._prefix_of(key), st.st_size, st.st_mtime
+
+    def touch(self, accesses):
+        # mtime doubles as stored_at, so access stats aren't kept for files;
+        # eviction falls back to oldest-written first
+        pass
+
+    def purge_expired(self, max_age_for, now=None):
+        """Delete files older than max_age_for(prefix) allows; returns the number removed"""
+        now = now if now is not None else time.time()
+        removed = 0
+        for path, prefix, _, stored_at in self._entries():
+            if now - stored_at >= max_age_for(prefix):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def usage(self):
+        """Return {prefix: {'entries': n, 'bytes': b}}"""
+        usage = {}
+        for _, prefix, size, _ in self._entries():
+            stats = usage.setdefault(prefix, {'entries': 0, 'bytes': 0})
+            stats['entries'] += 1
+            stats['bytes'] += size
+        return usage
+
+    def evict(self, max_bytes, prefix=None, policy='lru'):
+        """Remove the oldest files until the (prefix's) total is within max_bytes"""
+        entries = [e for e in self._entries() if prefix is None or e[1] == prefix]
+        total = sum(e[2] for e in entries)
+        removed = 0
+        for path, _, size, _ in sorted(entries, key=lambda e: e[3]):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def sample(self, prefix, limit):
+        """Return up to limit stored payloads for a prefix"""
+        payloads = []
+        for path, entry_prefix, _, _ in self._entries():
+            if len(payloads) >= limit:
+                break
+            if entry_prefix == prefix:
+                try:
+                    with open(path, 'rb') as f:
+                        payloads.append(f.read())
+                except OSError:
+                    pass
+        return payloads
+
+    def compact(self):
+        """Remove temp files left behind by interrupted writes"""
+        for path in glob.glob(os.path.join(self.cache_dir, '.tmp-*')):
+            if time.time() - os.path.getmtime(path) > 3600:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class SQLiteBackend:
+    """
+    All entries in one SQLite database in WAL mode.
+
+    Every write is its own transaction, so readers never see a partial entry,
+    and WAL lets several worker processes read while one writes. expires_at is
+    the hard expiry (TTL + stale grace) and is indexed for bulk purging.
+    last_access and hits feed LRU/LFU eviction; they are written in batches
+    by the janitor, never on the read path.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            key TEXT PRIMARY KEY,
+            prefix TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            stored_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL DEFAULT 0,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_cache_entries_expires_at ON cache_entries (expires_at);
+        CREATE INDEX IF NOT EXISTS idx_cache_entries_prefix ON cache_entries (prefix);
+    """
+
+    # Columns added after the first release of the schema
+    MIGRATIONS = {
+        'last_access': 'ALTER TABLE cache_entries ADD COLUMN last_access REAL NOT NULL DEFAULT 0',
+        'hits': 'ALTER TABLE cache_entries ADD COLUMN hits INTEGER NOT NULL DEFAULT 0',
+    }
+
+    EVICTION_ORDER = {
+        'lru': 'last_access ASC, stored_at ASC',
+        'lfu': 'hits ASC, last_access ASC',
+    }
+
+    def __init__(self, db_path, busy_timeout=30):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._migrate()
+
+    def _migrate(self):
+        conn = self._connect()
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(cache_entries)')}
+        if columns:
+            for column, statement in self.MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+        conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        # One connection per thread, re-opened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT payload, stored_at FROM cache_entries WHERE key = ? AND expires_at > ?',
+            (key, time.time())
+        ).fetchone()
+        return (bytes(row[0]), row[1]) if row else None
+
+    def set(self, key, key_prefix, payload, stored_at, expires_at):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO cache_entries (key, prefix, payload, size, stored_at, expires_at, last_access) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, key_prefix or '', sqlite3.Binary(payload), len(payload), stored_at, expires_at, stored_at)
+        )
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+    def touch(self, accesses):
+        """Apply batched access stats: {key: (last_access, hit_count)}"""
+        if not accesses:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany(
+                'UPDATE cache_entries SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?',
+                [(last_access, count, key) for key, (last_access, count) in accesses.items()]
+            )
+
+    def purge_expired(self, max_age_for=None, now=None):
+        """Delete every entry past its hard expiry; returns the number removed"""
+        cursor = self._connect().execute(
+            'DELETE FROM cache_entries WHERE expires_at <= ?',
+            (now if now is not None else time.time(),)
+        )
+        return cursor.rowcount
+
+    def usage(self):
+        """Return {prefix: {'entries': n, 'bytes': b}}"""
+        rows = self._connect().execute(
+            'SELECT prefix, COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries GROUP BY prefix'
+        )
+        return {prefix: {'entries': count, 'bytes': size} for prefix, count, size in rows}
+
+    def evict(self, max_bytes, prefix=None, policy='lru'):
+        """Remove the least recently/frequently used entries until the total fits max_bytes"""
+        conn = self._connect()
+        where, params = ('WHERE prefix = ?', (prefix,)) if prefix is not None else ('', ())
+        total = conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM cache_entries {where}', params).fetchone()[0]
+        if total <= max_bytes:
+            return 0
+
+        victims = []
+        rows = conn.execute(
+            f'SELECT key, size FROM cache_entries {where} ORDER BY {self.EVICTION_ORDER[policy]}',
+            params
+        )
+        for key, size in rows:
+            if total <= max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany('DELETE FROM cache_entries WHERE key = ?', victims)
+        return len(victims)
+
+    def sample(self, prefix, limit):
+        """Return up to limit stored payloads for a prefix"""
+        rows = self._connect().execute(
+            'SELECT payload FROM cache_entries WHERE prefix = ? LIMIT ?', (prefix, limit)
+        )
+        return [bytes(row[0]) for row in rows]
+
+    def compact(self):
+        """Fold the WAL back into the database and reclaim free pages"""
+        conn = self._connect()
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
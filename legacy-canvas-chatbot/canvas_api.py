@@ -0,0 +1,93 @@
+import http_client
+from workers import executor
+
+# Page size requested from Canvas list endpoints (Canvas caps this at 100)
+CANVAS_PER_PAGE = 50
+
+
+class CanvasAPIError(Exception):
+    def __init__(self, url, status_code):
+        super().__init__(f"Canvas request failed ({status_code}): {url}")
+        self.url = url
+        self.status_code = status_code
+
+
+class CanvasPaginationError(Exception):
+    """A page after the first failed, so the items already yielded are only part of the list"""
+    def __init__(self, url, cause):
+        super().__init__(f"Canvas pagination stopped early at {url}: {cause}")
+        self.url = url
+        self.cause = cause
+
+
+def _fetch_page(url, headers, params, timeout):
+    response = http_client.get(url, headers=headers, params=params, timeout=timeout)
+    if response.status_code != 200:
+        raise CanvasAPIError(url, response.status_code)
+
+    data = response.json()
+    next_url = response.links.get('next', {}).get('url')
+    return (data if isinstance(data, list) else []), next_url
+
+
+def paginate(url, headers, params=None, limit=None, prefetch=False, timeout=10):
+    """
+    Lazily yield items from a Canvas list endpoint, following Link rel="next".
+
+    Stops after `limit` items, or as soon as the caller stops iterating, so no
+    page is requested that isn't needed. With prefetch=True the next page is
+    requested on the worker pool while the current one is being consumed -
+    only use that from request threads, never from inside a pool task.
+
+    A failure on the first page raises CanvasAPIError; a failure on a later
+    page raises CanvasPaginationError after the items already yielded, so
+    callers never mistake a truncated list for a complete one.
+    """
+    params = dict(params or {})
+    params.setdefault('per_page', CANVAS_PER_PAGE)
+
+    items, next_url = _fetch_page(url, headers, params, timeout)
+    yielded = 0
+    pending = None
+
+    try:
+        while True:
+            # The next link already carries the query string, so params are only sent once
+            if prefetch and next_url:
+                pending = executor.submit(_fetch_page, next_url, headers, None, timeout)
+
+            for item in items:
+                yield item
+                yielded += 1
+                if limit is not None and yielded >= limit:
+                    return
+
+            if not next_url:
+                return
+
+            try:
+                if pending is not None:
+                    items, next_url = pending.result()
+                    pending = None
+                else:
+                    items, next_url = _fetch_page(next_url, headers, None, timeout)
+            except Exception as e:
+                raise CanvasPaginationError(next_url, e) from e
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def fetch_list(url, headers, **kwargs):
+    """
+    Every item paginate() yields, as (items, complete). complete is False when
+    a later page failed and items is only the part before it.
+    """
+    items = []
+    try:
+        for item in paginate(url, headers, **kwargs):
+            items.append(item)
+    except CanvasPaginationError as e:
+        print(f"⚠️ {str(e)}")
+        return items, False
+    return items, True
@@ -0,0 +1,168 @@
+import re
+import math
+import hashlib
+import threading
+from collections import Counter, OrderedDict, namedtuple
+
+# Page bodies, PDF text, transcripts and assignment descriptions are split into
+# overlapping chunks and scored against the query with BM25, so an oversized
+# module summary only sends the most relevant parts of each document.
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP_CHARS = 150
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Rough chars-per-token ratio for budgeting; close enough for English prose
+CHARS_PER_TOKEN = 4
+
+# Course indexes are kept in memory, least recently used dropped first
+MAX_INDEXED_COURSES = 256
+
+STOP_WORDS = {
+    'the', 'and', 'of', 'in', 'to', 'a', 'an', 'for', 'with', 'on', 'at', 'is', 'are', 'was',
+    'be', 'by', 'or', 'as', 'it', 'this', 'that', 'from', 'what', 'my', 'me', 'give', 'show',
+    'tell', 'about', 'summarize', 'summary', 'explain', 'describe', 'please', 'can', 'you',
+}
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# A body of text inside a rendered item that may be trimmed to its relevant chunks
+ContentBody = namedtuple('ContentBody', ['doc_id', 'text'])
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def tokenize(text):
+    return [t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in STOP_WORDS]
+
+
+def split_into_chunks(text, chunk_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP_CHARS):
+    """Split text into ~chunk_chars pieces, preferring sentence then word boundaries"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            floor = start + chunk_chars // 2
+            cut = text.rfind('. ', floor, end)
+            if cut == -1:
+                cut = text.rfind(' ', floor, end)
+            if cut != -1:
+                end = cut + 1
+
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+
+        # Restart a little before the cut, on a word boundary, so no sentence is lost between chunks
+        next_start = text.find(' ', max(start + 1, end - overlap), end)
+        start = next_start + 1 if next_start != -1 else end
+    return chunks
+
+
+class CourseIndex:
+    """BM25 index over the chunked documents of one course"""
+
+    def __init__(self):
+        self._docs = {}  # doc_id -> (fingerprint, [chunk ids])
+        self._chunks = {}  # chunk id -> (doc_id, position, text, term counts, length)
+        self._df = Counter()
+        self._total_length = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add_document(self, doc_id, text):
+        """Index text under doc_id; re-indexes only if the text changed"""
+        fingerprint = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            existing = self._docs.get(doc_id)
+            if existing and existing[0] == fingerprint:
+                return
+            if existing:
+                self._remove(doc_id)
+
+            chunk_ids = []
+            for position, chunk in enumerate(split_into_chunks(text)):
+                terms = Counter(tokenize(chunk))
+                length = sum(terms.values())
+                self._chunks[self._next_id] = (doc_id, position, chunk, terms, length)
+                self._df.update(terms.keys())
+                self._total_length += length
+                chunk_ids.append(self._next_id)
+                self._next_id += 1
+            self._docs[doc_id] = (fingerprint, chunk_ids)
+
+    def _remove(self, doc_id):
+        _, chunk_ids = self._docs.pop(doc_id)
+        for chunk_id in chunk_ids:
+            _, _, _, terms, length = self._chunks.pop(chunk_id)
+            self._df.subtract(terms.keys())
+            self._total_length -= length
+
+    def select(self, query, doc_ids, token_budget):
+        """
+        Pick the best-scoring chunks of doc_ids that fit in token_budget.
+
+        Ties (including a query that matches nothing, like "summarize week 3")
+        go to earlier chunks and earlier documents, so weak queries get the
+        opening of every document rather than all of the first one.
+        Returns {doc_id: [chunk text, ...]} with chunks in document order.
+        """
+        query_terms = set(tokenize(query))
+        doc_rank = {doc_id: rank for rank, doc_id in enumerate(doc_ids)}
+
+        with self._lock:
+            n_chunks = len(self._chunks) or 1
+            avg_length = (self._total_length / n_chunks) or 1
+            idf = {
+                term: math.log(1 + (n_chunks - self._df[term] + 0.5) / (self._df[term] + 0.5))
+                for term in query_terms
+            }
+
+            candidates = []
+            for doc_id in doc_rank:
+                if doc_id not in self._docs:
+                    continue
+                for chunk_id in self._docs[doc_id][1]:
+                    _, position, text, terms, length = self._chunks[chunk_id]
+                    score = 0.0
+                    for term in query_terms:
+                        tf = terms.get(term, 0)
+                        if tf:
+                            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                            score += idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+                    candidates.append((score, position, doc_rank[doc_id], doc_id, text))
+
+        candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+
+        selected = {}
+        used = 0
+        for _, position, _, doc_id, text in candidates:
+            tokens = estimate_tokens(text)
+            if used + tokens > token_budget:
+                continue
+            selected.setdefault(doc_id, []).append((position, text))
+            used += tokens
+
+        return {doc_id: [text for _, text in sorted(chunks)] for doc_id, chunks in selected.items()}
+
+
+_course_indexes = OrderedDict()
+_course_indexes_lock = threading.Lock()
+
+
+def get_course_index(course_key):
+    with _course_indexes_lock:
+        index = _course_indexes.get(course_key)
+        if index is None:
+            index = CourseIndex()
+            _course_indexes[course_key] = index
+            while len(_course_indexes) > MAX_INDEXED_COURSES:
+                _course_indexes.popitem(last=False)
+        else:
+            _course_indexes.move_to_end(course_key)
+        return index
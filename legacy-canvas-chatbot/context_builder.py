@@ -0,0 +1,97 @@
+from chunk_index import estimate_tokens, CHARS_PER_TOKEN
+
+# Overall token budget for the Canvas context sent to Gemini with each turn
+CONTEXT_TOKEN_BUDGET = 45000
+
+TRUNCATION_MARKER = "\n    [... truncated to fit the context budget]\n"
+
+
+class ContextSection:
+    """Text parts of one named context section, joined only once when the context is built"""
+
+    def __init__(self, name, priority, budget=None):
+        self.name = name
+        self.priority = priority
+        self.budget = budget
+        self.parts = []
+
+    def add(self, text):
+        self.parts.append(text)
+
+    def text(self):
+        return ''.join(self.parts)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to roughly max_tokens, on a line boundary where possible"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARKER))
+    cut = text.rfind('\n', 0, max_chars)
+    if cut < max_chars // 2:
+        cut = max_chars
+    return text[:cut] + TRUNCATION_MARKER if cut > 0 else ''
+
+
+class ContextBuilder:
+    """
+    Assembles the Canvas context from named sections.
+
+    Sections are output in the order they were created. Each one is first cut
+    to its own budget; if the whole context is still over the overall budget,
+    sections are truncated starting from the lowest priority (highest number).
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.sections = []
+        self._usage = {}
+
+    def section(self, name, priority, budget=None):
+        section = ContextSection(name, priority, budget)
+        self.sections.append(section)
+        return section
+
+    def build(self):
+        texts = {}
+        tokens = {}
+        truncated = set()
+        for section in self.sections:
+            text = section.text()
+            if section.budget is not None and estimate_tokens(text) > section.budget:
+                text = truncate_to_tokens(text, section.budget)
+                truncated.add(section.name)
+            texts[section.name] = text
+            tokens[section.name] = estimate_tokens(text) if text else 0
+
+        overflow = sum(tokens.values()) - self.token_budget
+        for section in sorted(self.sections, key=lambda s: -s.priority):
+            if overflow <= 0:
+                break
+            if not tokens[section.name]:
+                continue
+            keep = max(0, tokens[section.name] - overflow)
+            texts[section.name] = truncate_to_tokens(texts[section.name], keep)
+            truncated.add(section.name)
+            new_tokens = estimate_tokens(texts[section.name]) if texts[section.name] else 0
+            overflow -= tokens[section.name] - new_tokens
+            tokens[section.name] = new_tokens
+
+        self._usage = {
+            section.name: {'tokens': tokens[section.name], 'budget': section.budget,
+                           'truncated': section.name in truncated}
+            for section in self.sections
+        }
+        return ''.join(texts[section.name] for section in self.sections)
+
+    def report(self):
+        """Tokens used per section by the last build()"""
+        return self._usage
+
+    def log_usage(self):
+        used = ', '.join(
+            f"{name}={stats['tokens']}{' (truncated)' if stats['truncated'] else ''}"
+            for name, stats in self._usage.items() if stats['tokens']
+        )
+        total = sum(stats['tokens'] for stats in self._usage.values())
+        print(f"🧮 Context tokens: {total}/{self.token_budget} [{used}]")
@@ -0,0 +1,161 @@
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+# Set COURSE_MATCH_DEBUG=1 to print every phrase/word/abbreviation match and its score
+COURSE_MATCH_DEBUG = os.environ.get('COURSE_MATCH_DEBUG', '').lower() in ('1', 'true', 'yes')
+
+# Matchers are kept per user and rebuilt only when their course list changes
+MAX_CACHED_MATCHERS = 1024
+
+# Query words shorter than this are ignored
+MIN_WORD_LENGTH = 3
+
+COURSE_CODE_RE = re.compile(r'\b[A-Z]{2,4}\d{4,5}\b')
+
+STOP_WORDS = {
+    'the', 'and', 'of', 'in', 'to', 'a', 'an', 'for', 'with', 'on', 'at',
+    '2024', '2025', '2026', 'semester', 'term', 'quarter', 'spring', 'fall', 'summer', 'winter',
+    'hs1', 'hs2', 'h1', 'h2', 's1', 's2', 't1', 't2', 't3', 'q1', 'q2', 'q3', 'q4',
+    'what', 'is', 'my', 'give', 'me', 'show', 'tell', 'about', 'from',
+    'summarize', 'summary', 'explain', 'describe', 'week', 'module', 'lecture'
+}
+
+COMMON_ABBREVIATIONS = {
+    'oop': ['object oriented programming', 'object-oriented programming'],
+    'dsa': ['data structures', 'algorithms', 'data structures and algorithms'],
+    'ml': ['machine learning'],
+    'ai': ['artificial intelligence'],
+    'db': ['database'],
+    'os': ['operating system'],
+    'cn': ['computer network'],
+    'se': ['software engineering'],
+    'calc': ['calculus'],
+    'bio': ['biology'],
+    'chem': ['chemistry'],
+    'phys': ['physics'],
+    'stats': ['statistics'],
+    'econ': ['economics'],
+    'psych': ['psychology'],
+    'cs': ['computer science'],
+    'it': ['information technology']
+}
+
+
+def _substring_index(texts):
+    """
+    Map every substring (of at least MIN_WORD_LENGTH chars) of every
+    whitespace-separated token to the set of text positions containing it.
+
+    A query word never contains whitespace, so `word in text` holds exactly
+    when the word is a key here.
+    """
+    index = defaultdict(set)
+    for position, text in enumerate(texts):
+        for token in set(text.split()):
+            for start in range(len(token) - MIN_WORD_LENGTH + 1):
+                for end in range(start + MIN_WORD_LENGTH, len(token) + 1):
+                    index[token[start:end]].add(position)
+    return index
+
+
+class CourseMatcher:
+    """
+    Precompiled lookup structures for matching a query to one of a user's courses.
+
+    Scores are the same as the original scan: +3 per word of every query
+    phrase found in the course name, +1 per query word in the name (else +2
+    if it is in the course code), +5 per abbreviation whose expansion is in
+    the name. A course code in the query wins outright.
+    """
+
+    def __init__(self, courses):
+        self.courses = courses
+        self.names = [(course.get('name') or '').lower() for course in courses]
+        self.upper_codes = [(course.get('course_code') or '').upper() for course in courses]
+        self.name_index = _substring_index(self.names)
+        self.code_index = _substring_index([code.lower() for code in self.upper_codes])
+        self.abbreviation_index = {
+            abbreviation: [position for position, name in enumerate(self.names)
+                           if any(term in name for term in terms)]
+            for abbreviation, terms in COMMON_ABBREVIATIONS.items()
+        }
+
+    def _trace(self, debug, message):
+        if debug:
+            print(message)
+
+    def match(self, query_lower, debug=COURSE_MATCH_DEBUG):
+        """Return (course, score) for the best match, or (None, best_score); score is None for a code match"""
+        self._trace(debug, f"🔍 Searching for course in query: '{query_lower}'")
+
+        course_code_match = COURSE_CODE_RE.search(query_lower.upper())
+        if course_code_match:
+            course_code = course_code_match.group(0)
+            for position, upper_code in enumerate(self.upper_codes):
+                if course_code in upper_code:
+                    return self.courses[position], None
+
+        query_words = [word for word in query_lower.split() if word not in STOP_WORDS and len(word) >= MIN_WORD_LENGTH]
+
+        scores = defaultdict(int)
+        name_candidates = set()
+        for word in query_words:
+            in_name = self.name_index.get(word, set())
+            name_candidates |= in_name
+            for position in in_name:
+                scores[position] += 1
+                self._trace(debug, f"  🔎 Word match '{word}' in {self.courses[position].get('name')}: +1")
+            for position in self.code_index.get(word, set()) - in_name:
+                scores[position] += 2
+                self._trace(debug, f"  🔎 Code match '{word}' in {self.courses[position].get('course_code')}: +2")
+            for position in self.abbreviation_index.get(word, ()):
+                scores[position] += 5
+                self._trace(debug, f"  🔎 Abbreviation match '{word}' in {self.courses[position].get('name')}: +5")
+
+        # A phrase can only be in the name if its first word is, and once
+        # words[i:j] is missing no longer phrase from i can be present
+        for position in name_candidates:
+            name = self.names[position]
+            for start in range(len(query_words)):
+                end = start + 1
+                while end <= len(query_words):
+                    phrase = ' '.join(query_words[start:end])
+                    if phrase not in name:
+                        break
+                    scores[position] += (end - start) * 3
+                    self._trace(debug, f"  🔎 Phrase match '{phrase}' in {self.courses[position].get('name')}: +{(end - start) * 3}")
+                    end += 1
+
+        # Ties go to the course listed first, as in the original scan
+        best_match = None
+        best_score = 0
+        for position in sorted(scores):
+            if scores[position] > best_score:
+                best_score = scores[position]
+                best_match = self.courses[position]
+                self._trace(debug, f"  ⭐ New best match: {best_match.get('name')} (score: {best_score})")
+        return best_match, best_score
+
+
+_matchers = OrderedDict()
+_matchers_lock = threading.Lock()
+
+
+def get_course_matcher(user_id, courses):
+    """Return the user's matcher, rebuilding it only if their course list changed"""
+    fingerprint = hash(tuple((c.get('id'), c.get('name'), c.get('course_code')) for c in courses))
+    with _matchers_lock:
+        cached = _matchers.get(user_id)
+        if cached and cached[0] == fingerprint:
+            _matchers.move_to_end(user_id)
+            return cached[1]
+
+    matcher = CourseMatcher(courses)
+    with _matchers_lock:
+        _matchers[user_id] = (fingerprint, matcher)
+        _matchers.move_to_end(user_id)
+        while len(_matchers) > MAX_CACHED_MATCHERS:
+            _matchers.popitem(last=False)
+    return matcher
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+import http_client
+from cache import cached
+from workers import executor
+
+# Gemini REST endpoint. Override with GEMINI_API_BASE to point the app at a
+# local mock server (see mock_gemini.py).
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta').rstrip('/')
+
+# Context caching: register the static system prompt once per key and model as
+# a cachedContents resource and reference it from every request instead of
+# resending it. Off by default; models have a minimum cacheable token count, and
+# keys or models that can't create a cache fall back to the inline prompt.
+GEMINI_CONTEXT_CACHING = os.environ.get('GEMINI_CONTEXT_CACHING', '').lower() in ('1', 'true', 'yes')
+CACHED_CONTENT_TTL_SECONDS = 3600
+# How long to stop trying after a cachedContents resource could not be created
+CACHED_CONTENT_RETRY_SECONDS = 600
+
+# Models /api/verify-key will use, most preferred first
+PREFERRED_MODELS = [
+    'gemini-2.0-flash-exp',
+    'gemini-exp-1206',
+    'gemini-2.0-flash',
+    'gemini-2.5-flash',
+    'gemini-2.5-pro',
+    'gemini-2.5-pro-preview-03-25'
+]
+
+MODEL_PROBE_TIMEOUT = 10
+
+# Used for keys that no model has been discovered for yet
+DEFAULT_MODEL = 'gemini-1.5-pro'
+
+# Tried in order after the selected model when it answers 429 or 5xx
+MODEL_FALLBACK_CHAIN = ['gemini-2.0-flash', 'gemini-2.5-flash']
+
+# Optional JSON file the registry is saved to, so model choices survive a
+# restart. None keeps the registry in memory only.
+MODEL_REGISTRY_PATH = None
+
+# Written by older versions of /api/verify-key; read once at startup as the default
+LEGACY_MODEL_FILE = 'gemini_model.txt'
+
+
+class InvalidAPIKeyError(Exception):
+    pass
+
+
+def key_fingerprint(api_key):
+    """Non-reversible id for an API key, safe for cache keys and the session"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+class ModelRegistry:
+    """
+    Model choice per API key fingerprint, held in memory.
+
+    Reads never touch disk. Updates replace the entry under a lock and, when
+    a path is configured, rewrite the file atomically (temp file + rename).
+    Saves are serialised and each writes the latest models, so the file never
+    ends up older than memory.
+    """
+
+    def __init__(self, path=None, default_model=DEFAULT_MODEL):
+        self.path = path
+        self.default_model = default_model
+        self._models = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def load(self, legacy_model_file=None):
+        if legacy_model_file and os.path.exists(legacy_model_file):
+            try:
+                with open(legacy_model_file, 'r') as f:
+                    saved_model = f.read().strip()
+                if saved_model:
+                    self.default_model = saved_model
+                    print(f"📖 Default model from {legacy_model_file}: {saved_model}")
+            except Exception as e:
+                print(f"⚠️ Error reading model file: {e}")
+
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    models = json.load(f)
+                with self._lock:
+                    self._models = dict(models)
+                print(f"📖 Loaded {len(models)} saved model choices")
+            except Exception as e:
+                print(f"⚠️ Error reading model registry: {e}")
+
+    def get(self, fingerprint):
+        return self._models.get(fingerprint)
+
+    def set(self, fingerprint, model_name):
+        with self._lock:
+            if self._models.get(fingerprint) == model_name:
+                return
+            self._models[fingerprint] = model_name
+        if self.path:
+            self._save()
+
+    def _save(self):
+        # Snapshot after taking the save lock: whichever save runs last then
+        # writes every update made before it
+        with self._save_lock:
+            with self._lock:
+                models = dict(self._models)
+            self._write(models)
+
+    def _write(self, models):
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-models-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(models, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Error saving model registry: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def fallback_chain(self, model_name):
+        """The given model first, then MODEL_FALLBACK_CHAIN without duplicates"""
+        model_name = model_name or self.default_model
+        return [model_name] + [m for m in MODEL_FALLBACK_CHAIN if m != model_name]
+
+
+model_registry = ModelRegistry(MODEL_REGISTRY_PATH)
+model_registry.load(LEGACY_MODEL_FILE)
+
+
+def post_with_fallback(model_name, method, api_key, payload, params=None, **kwargs):
+    """
+    POST payload to models/{model}:{method}, moving down the fallback chain
+    while a model answers 429 or 5xx. payload may be a callable taking the
+    model name, for bodies that depend on the model. Returns (response, model
+    used). A fallback model the key can't use (any other 4xx) is skipped, and
+    if every model failed the first 429/5xx is returned, so callers report
+    the rate limit or outage rather than a 404 from a fallback.
+    """
+    first_error = None
+    for candidate in model_registry.fallback_chain(model_name):
+        response = http_client.post(
+            f'{GEMINI_API_BASE}/models/{candidate}:{method}',
+            params={'key': api_key, **(params or {})},
+            json=payload(candidate) if callable(payload) else payload,
+            **kwargs
+        )
+        retryable = response.status_code == 429 or response.status_code >= 500
+        if first_error is None and not retryable:
+            return response, candidate
+        if first_error is not None and response.status_code < 400:
+            first_error[0].close()
+            return response, candidate
+
+        print(f"⚠️ {candidate} returned {response.status_code}, trying the next model")
+        if first_error is None:
+            first_error = (response, candidate)
+        else:
+            response.close()
+    return first_error
+
+
+_cached_contents = {}  # (key fingerprint, model, text digest) -> (resource name, expires_at)
+_cached_content_failures = {}  # same key -> retry after
+_cached_contents_lock = threading.Lock()
+
+
+def get_cached_content(api_key, model_name, system_text):
+    """
+    Name of a cachedContents resource holding system_text as the system
+    instruction for this key and model, created on first use. Returns None if
+    one can't be created; the caller then sends the prompt inline.
+    """
+    key = (key_fingerprint(api_key), model_name, hashlib.sha256(system_text.encode('utf-8')).hexdigest()[:16])
+    now = time.time()
+    with _cached_contents_lock:
+        entry = _cached_contents.get(key)
+        # Leave a minute of margin so a request never references a cache that expires in flight
+        if entry and entry[1] - 60 > now:
+            return entry[0]
+        if _cached_content_failures.get(key, 0) > now:
+            return None
+
+    try:
+        response = http_client.post(
+            f'{GEMINI_API_BASE}/cachedContents',
+            params={'key': api_key},
+            json={
+                'model': f'models/{model_name}',
+                'system_instruction': {'parts': [{'text': system_text}]},
+                'ttl': f'{CACHED_CONTENT_TTL_SECONDS}s'
+            },
+            timeout=MODEL_PROBE_TIMEOUT
+        )
+        if response.status_code != 200:
+            raise Exception(f"{response.status_code} - {response.text}")
+        name = response.json()['name']
+    except Exception as e:
+        print(f"⚠️ Could not create cached content for {model_name}, sending the prompt inline: {str(e)}")
+        with _cached_contents_lock:
+            _cached_content_failures[key] = now + CACHED_CONTENT_RETRY_SECONDS
+        return None
+
+    print(f"🗄️ Created cached content {name} for {model_name}")
+    with _cached_contents_lock:
+        _cached_contents[key] = (name, now + CACHED_CONTENT_TTL_SECONDS)
+    return name
+
+
+def list_generate_models(api_key):
+    """
+    Names of the models this key may call generateContent on.
+
+    Raises InvalidAPIKeyError when Google rejects the key outright; returns
+    None if the list is unavailable for any other reason.
+    """
+    response = http_client.get(
+        f'{GEMINI_API_BASE}/models',
+        params={'key': api_key, 'pageSize': 1000},
+        timeout=MODEL_PROBE_TIMEOUT
+    )
+    if response.status_code in (400, 401, 403):
+        raise InvalidAPIKeyError(f"Gemini rejected the API key: {response.status_code}")
+    if response.status_code != 200:
+        print(f"⚠️ Could not list Gemini models: {response.status_code}")
+        return None
+
+    return {
+        model.get('name', '').split('/', 1)[-1]
+        for model in response.json().get('models', [])
+        if 'generateContent' in model.get('supportedGenerationMethods', [])
+    }
+
+
+def probe_model(model_name, api_key):
+    """True if a tiny generateContent call on the model succeeds (key valid and quota left)"""
+    try:
+        response = http_client.post(
+            f'{GEMINI_API_BASE}/models/{model_name}:generateContent?key={api_key}',
+            json={
+                'contents': [{'parts': [{'text': 'Hi'}]}],
+                'generationConfig': {'maxOutputTokens': 10}
+            },
+            timeout=MODEL_PROBE_TIMEOUT
+        )
+    except Exception as e:
+        print(f"✖ Model {model_name} error: {str(e)}")
+        return False
+
+    if response.status_code != 200:
+        print(f"✖ Model {model_name} failed: {response.status_code} - {response.text}")
+        return False
+    return True
+
+
+@cached(key_prefix='gemini_model', key_args=('fingerprint',), per_user=False)
+def discover_model(fingerprint, api_key):
+    """
+    Most preferred model that works with this key, or None.
+
+    The models list filters out models the key can't see (and fails fast on
+    an invalid key). Each probe is a billable call, so the most preferred
+    candidate is probed alone first; only if it fails are the rest probed
+    concurrently, and the first working one in preference order wins.
+    Results are cached per key fingerprint; failures are not, so a
+    rate-limited key is retried next time.
+    """
+    try:
+        available = list_generate_models(api_key)
+    except InvalidAPIKeyError as e:
+        print(f"✖ {str(e)}")
+        return None
+    except Exception as e:
+        print(f"⚠️ Could not list Gemini models: {str(e)}")
+        available = None
+
+    candidates = [model for model in PREFERRED_MODELS if available is None or model in available] or PREFERRED_MODELS
+    if probe_model(candidates[0], api_key):
+        print(f"✅ Found working model: {candidates[0]}")
+        return candidates[0]
+
+    futures = [(model, executor.submit(probe_model, model, api_key)) for model in candidates[1:]]
+    try:
+        for model, future in futures:
+            if future.result():
+                print(f"✅ Found working model: {model}")
+                return model
+    finally:
+        for _, future in futures:
+            future.cancel()
+    return None
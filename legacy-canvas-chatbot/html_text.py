@@ -0,0 +1,285 @@
+import re
+import sys
+import html
+import timeit
+from bisect import bisect_right
+from itertools import repeat
+
+# Tags that start a new line of text; their boundaries become a space
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'figcaption',
+    'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav',
+    'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul',
+}
+
+# Tags whose content is never prompt text
+SKIP_TAGS = {'script', 'style', 'noscript', 'template'}
+
+# A capped document this many times larger than its character cap is
+# tokenised and abandoned at the cap; anything smaller is cheaper to split in
+# one regex pass and join
+STREAMING_MARKUP_RATIO = 8
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Attributes of a tag up to its closing '>'. Quoted values may contain '>' or
+# '<'; unquoted runs stop at '<', so a tag that is never closed fails at the
+# next tag instead of scanning on to the end of the document.
+_ATTRS = r"""[^'"<>]*(?:"[^"]*"[^'"<>]*|'[^']*'[^'"<>]*)*"""
+
+# A skipped element with its content, or a comment (group 1: skipped tag name).
+# The lookahead on the first character lets most '<' fail before the
+# alternatives are tried.
+_SKIP_FIRST_CHARS = ''.join(sorted({c for tag in SKIP_TAGS for c in (tag[0], tag[0].upper())}))
+_SKIP = r'<(?=[' + _SKIP_FIRST_CHARS + r'!])(?:(' + '|'.join(SKIP_TAGS) + r')\b.*?(?:</\1\s*>|$)|!--.*?(?:-->|$))'
+
+# Every token in one pass: skipped content (group 1), a start/end tag with its
+# name including any '/' (group 2) and attributes (group 3), or a doctype /
+# processing instruction. re.split leaves the text between them.
+_SPLIT_RE = re.compile(_SKIP + r'|<(?:(/?[a-zA-Z][^\s/<>]*)(' + _ATTRS + r')|[!?][^<>]*)>', re.S | re.I)
+
+# The same tokens for the streaming path, plus runs of text (a stray '<' is
+# treated as text): skipped (1), '/' (2), name (3), attributes (4), text (5)
+_TOKEN_RE = re.compile(
+    _SKIP + r'|<(/?)([a-zA-Z][^\s/<>]*)(' + _ATTRS + r')>|<[!?][^<>]*>|([^<]+|<)',
+    re.S | re.I
+)
+
+# Tokens after the cap in the streaming path, where only <a> attributes (group
+# 2) are wanted; other tags are still matched whole so they are stepped over
+# exactly as in the split
+_LINK_RE = re.compile(
+    _SKIP + r'|<(?=[aA])a\s(' + _ATTRS + r')>|<(?:/?[a-zA-Z][^\s/<>]*' + _ATTRS + r'|[!?][^<>]*)>',
+    re.S | re.I
+)
+
+# href in an attribute string, stepping over quoted values whole so an href
+# inside another attribute's value never counts
+_HREF_RE = re.compile(r"""(?:[^'"]|"[^"]*"|'[^']*')*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"']+))""", re.I)
+
+# Tag names as written in practice (lower, UPPER, Capitalised) -> what they
+# become in the text; any other tag is dropped
+_BLOCK_SEPARATORS = {
+    f'{slash}{name}': ' '
+    for tag in BLOCK_TAGS for name in (tag, tag.upper(), tag.capitalize()) for slash in ('', '/')
+}
+_TITLE_OPEN = ('title', 'TITLE', 'Title')
+_TITLE_CLOSE = ('/title', '/TITLE', '/Title')
+_ANCHOR_NAMES = ('a', 'A')
+
+
+class _TextCollector:
+    """Accumulates whitespace-normalised text up to a character cap"""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.pending_space = False
+
+    def add(self, data):
+        if '&' in data:
+            data = html.unescape(data)
+        collapsed = _WHITESPACE_RE.sub(' ', data)
+        stripped = collapsed.strip()
+        if not stripped:
+            if collapsed:
+                self.pending_space = True
+            return False
+
+        if self.length and (self.pending_space or collapsed[0] == ' '):
+            self.parts.append(' ')
+            self.length += 1
+        self.parts.append(stripped)
+        self.length += len(stripped)
+        self.pending_space = collapsed[-1] == ' '
+        return self.max_chars is not None and self.length >= self.max_chars
+
+
+def _normalise(text):
+    if '&' in text:
+        text = html.unescape(text)
+    return ' '.join(text.split())
+
+
+def _href(attrs):
+    """The href value in a tag's attribute string, or None"""
+    match = _HREF_RE.match(attrs)
+    if not match:
+        return None
+    href = ''.join(match.groups(''))
+    if '&' in href:
+        href = html.unescape(href)
+    return href.strip() or None
+
+
+def _positions(names, variants):
+    """Sorted indexes of any of variants in names (list.index keeps the scan in C)"""
+    positions = []
+    for variant in variants:
+        index = -1
+        while True:
+            try:
+                index = names.index(variant, index + 1)
+            except ValueError:
+                break
+            positions.append(index)
+    positions.sort()
+    return positions
+
+
+def _extract_whole(markup, max_links):
+    """
+    (title, text, urls) from one re.split of the document. The split leaves
+    text at parts[0::4] and each token's groups in between, so the text is
+    assembled by list slicing rather than per-token Python code.
+    """
+    parts = _SPLIT_RE.split(markup)
+    names = parts[2::4]
+    attrs = parts[3::4]
+
+    urls = []
+    for index in _positions(names, _ANCHOR_NAMES):
+        if max_links is not None and len(urls) >= max_links:
+            break
+        href = _href(attrs[index])
+        if href:
+            urls.append(href)
+
+    # Text between <title> and the next </title> (tag k is followed by the text at 4k+4)
+    titles = []
+    closings = _positions(names, _TITLE_CLOSE) + [len(names)]
+    closed_at = -1
+    for opening in _positions(names, _TITLE_OPEN):
+        if opening < closed_at:
+            continue
+        closed_at = closings[bisect_right(closings, opening)]
+        title_parts = []
+        for k in range(opening, closed_at):
+            title_parts.append(parts[4 * k + 4])
+            parts[4 * k + 4] = ''
+        titles.append(_normalise(''.join(title_parts)))
+
+    empty = [''] * len(names)
+    parts[1::4] = empty
+    parts[2::4] = list(map(_BLOCK_SEPARATORS.get, names, repeat('')))
+    parts[3::4] = empty
+    return ' '.join(title for title in titles if title), _normalise(''.join(parts)), urls
+
+
+def _extract_streaming(markup, max_chars, max_links):
+    """(title, text, urls), tokenising only until max_chars characters of text are collected"""
+    body = _TextCollector(max_chars)
+    title = _TextCollector(None)
+    in_title = False
+    urls = []
+    wants_links = max_links is None or max_links > 0
+    match = None
+    for match in _TOKEN_RE.finditer(markup):
+        _, closing, tag, attrs, text = match.groups()
+
+        if text is not None:
+            if in_title:
+                title.add(text)
+            elif body.add(text):
+                break
+            continue
+        if tag is None:  # script/style, comment, doctype
+            continue
+
+        tag = tag.lower()
+        if tag == 'title':
+            in_title = not closing
+        elif tag in BLOCK_TAGS:
+            body.pending_space = True
+        elif tag == 'a' and not closing and wants_links:
+            href = _href(attrs)
+            if href:
+                urls.append(href)
+                wants_links = max_links is None or len(urls) < max_links
+    else:
+        match = None
+
+    # Past the cap only links are still wanted; look for <a> tags alone
+    if match is not None and wants_links:
+        for link in _LINK_RE.finditer(markup, match.end()):
+            if link.group(2) is None:
+                continue
+            href = _href(link.group(2))
+            if href:
+                urls.append(href)
+                if max_links is not None and len(urls) >= max_links:
+                    break
+    return ''.join(title.parts), ''.join(body.parts), urls
+
+
+def extract_html_text(markup, max_chars=None, max_links=None):
+    """
+    Turn Canvas HTML into prompt text in a single pass over the markup.
+
+    Entities are decoded, script/style content dropped and whitespace
+    collapsed; block-level tags separate words. Tags end at the first '>'
+    outside a quoted attribute value. Documents much larger than max_chars
+    are tokenised only until the cap is reached.
+    Returns {'title', 'text', 'urls'} where urls are the <a href> values in
+    document order (at most max_links).
+    """
+    markup = markup or ''
+    if max_chars is not None and len(markup) > max_chars * STREAMING_MARKUP_RATIO:
+        title, text, urls = _extract_streaming(markup, max_chars, max_links)
+    else:
+        title, text, urls = _extract_whole(markup, max_links)
+    if max_chars is not None:
+        text = text[:max_chars]
+    return {
+        'title': title,
+        'text': text,
+        'urls': urls,
+    }
+
+
+def _regex_chain(markup, max_chars):
+    """The per-document re.sub chain extract_html_text replaced, kept for benchmarking"""
+    clean_text = re.sub(r'<br\s*/?>', '\n', markup)
+    clean_text = re.sub('<p>', '\n', clean_text)
+    clean_text = re.sub('<[^<]+?>', '', clean_text)
+    clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+    urls = re.findall(r'href=["\']([^"\\]+)["\\]', markup)
+    return clean_text[:max_chars], urls
+
+
+def _sample_page(paragraphs):
+    paragraph = (
+        '<p>Week 3 covers <strong>recursion</strong> &amp; <em>divide-and-conquer</em>. '
+        'Read <a href="https://example.com/reading">the reading</a> and watch '
+        "<a href='https://www.youtube.com/watch?v=abc123'>the lecture</a> before class.</p>\n"
+        '<div class="note"><ul><li>Quiz opens Monday</li><li>Lab 3 due Friday&nbsp;5pm</li></ul></div>\n'
+    )
+    return f'<html><head><title>Week 3</title><style>p {{ margin: 0 }}</style></head><body>{paragraph * paragraphs}</body></html>'
+
+
+def main(argv=None):
+    """Benchmark: python html_text.py [page.html ...]"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        documents = []
+        for path in argv:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                documents.append((path, f.read()))
+    else:
+        documents = [(f'sample ({n} paragraphs)', _sample_page(n)) for n in (10, 200, 5000)]
+
+    for max_chars in (None, 20000):
+        print(f"📏 Character cap: {max_chars or 'none'}")
+        for name, markup in documents:
+            runs = max(3, min(1000, 2000000 // max(1, len(markup))))
+            regex_time = timeit.timeit(lambda: _regex_chain(markup, max_chars), number=runs) / runs
+            extract_time = timeit.timeit(lambda: extract_html_text(markup, max_chars), number=runs) / runs
+            links_before = len(_regex_chain(markup, max_chars)[1])
+            links_after = len(extract_html_text(markup, max_chars)['urls'])
+            print(f"  {name}: {len(markup)} bytes | regex chain {regex_time * 1000:.2f} ms, {links_before} links"
+                  f" | extract_html_text {extract_time * 1000:.2f} ms, {links_after} links")
+
+
+if __name__ == '__main__':
+    main()
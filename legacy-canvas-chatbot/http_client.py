@@ -0,0 +1,69 @@
+import threading
+import http.cookiejar
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared keep-alive client for Canvas and Gemini calls. urllib3 keeps one
+# connection pool per host, so every request to *.instructure.com or
+# generativelanguage.googleapis.com reuses an already-open TLS connection.
+HTTP_POOL_CONNECTIONS = 16  # number of per-host pools kept alive
+HTTP_POOL_MAXSIZE = 32  # connections kept per host (>= worker threads)
+HTTP_TIMEOUT = 10  # default timeout in seconds when the caller gives none
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.3
+HTTP_RETRY_STATUSES = (502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session():
+    # Only idempotent methods are retried - a retried Gemini POST would bill twice
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    # The session is shared by every user, so it must never keep cookies: one
+    # student's Canvas session cookie would be sent with the next student's requests
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
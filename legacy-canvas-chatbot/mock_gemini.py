@@ -0,0 +1,135 @@
+import re
+import sys
+import json
+import time
+import argparse
+import itertools
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for the parts of the Gemini REST API the app uses, for local
+# development and load testing without a key or quota:
+#
+#   python mock_gemini.py --port 8765
+#   GEMINI_API_BASE=http://127.0.0.1:8765/v1beta python app.py
+#
+# Any key is accepted except "invalid". Every request is logged with the size
+# of its system instruction and contents, so prompt and cache savings are visible.
+
+MOCK_MODELS = ['gemini-2.0-flash-exp', 'gemini-2.0-flash', 'gemini-2.5-flash', 'gemini-2.5-pro']
+
+_MODEL_PATH_RE = re.compile(r'^/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)$')
+
+_cached_contents = {}  # name -> {'model', 'system_chars', 'expires_at'}
+_cache_ids = itertools.count(1)
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    failing_models = {}  # model -> status code to answer with
+    stream_chunks = 5
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message):
+        self._send_json(status, {'error': {'code': status, 'message': message}})
+
+    def _key_ok(self, query):
+        return query.get('key', [''])[0] not in ('', 'invalid')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/v1beta/models':
+            return self._error(404, 'Not found')
+        if not self._key_ok(parse_qs(url.query)):
+            return self._error(400, 'API key not valid')
+        self._send_json(200, {'models': [
+            {'name': f'models/{name}', 'supportedGenerationMethods': ['generateContent', 'countTokens']}
+            for name in MOCK_MODELS
+        ]})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self._key_ok(query):
+            return self._error(400, 'API key not valid')
+
+        if url.path == '/v1beta/cachedContents':
+            return self._create_cached_content(body)
+
+        match = _MODEL_PATH_RE.match(url.path)
+        if not match:
+            return self._error(404, 'Not found')
+        model, method = match.groups()
+        if model not in MOCK_MODELS:
+            return self._error(404, f'models/{model} is not found')
+        if model in self.failing_models:
+            return self._error(self.failing_models[model], f'Simulated failure for {model}')
+
+        system_chars = len(json.dumps(body.get('system_instruction', '')))
+        cached_name = body.get('cachedContent')
+        if cached_name:
+            cached = _cached_contents.get(cached_name)
+            if not cached or cached['expires_at'] < time.time():
+                return self._error(404, f'{cached_name} not found')
+            if cached['model'] != f'models/{model}':
+                return self._error(400, f'{cached_name} was created for {cached["model"]}')
+            system_chars = 0
+        contents_chars = len(json.dumps(body.get('contents', [])))
+        print(f"🧪 {method} {model}: system {system_chars} chars, contents {contents_chars} chars, cached={cached_name or '-'}")
+
+        answer = f"Mock answer from {model} ({contents_chars} chars of contents)."
+        if method == 'generateContent':
+            return self._send_json(200, _response(answer))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        words = answer.split(' ')
+        size = max(1, len(words) // self.stream_chunks)
+        for start in range(0, len(words), size):
+            text = ' '.join(words[start:start + size]) + ' '
+            self.wfile.write(f"data: {json.dumps(_response(text))}\r\n\r\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(0.05)
+
+    def _create_cached_content(self, body):
+        ttl = int(str(body.get('ttl', '3600s')).rstrip('s'))
+        name = f'cachedContents/mock-{next(_cache_ids)}'
+        system_chars = len(json.dumps(body.get('system_instruction', body.get('systemInstruction', ''))))
+        _cached_contents[name] = {'model': body.get('model'), 'system_chars': system_chars, 'expires_at': time.time() + ttl}
+        print(f"🧪 created {name} for {body.get('model')}: {system_chars} chars")
+        self._send_json(200, {'name': name, 'model': body.get('model')})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _response(text):
+    return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}}]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local mock of the Gemini REST API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fail', action='append', default=[], metavar='MODEL:STATUS',
+                        help='answer every call to MODEL with STATUS, e.g. gemini-2.0-flash-exp:429')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    for spec in args.fail:
+        model, status = spec.rsplit(':', 1)
+        MockGeminiHandler.failing_models[model] = int(status)
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), MockGeminiHandler)
+    print(f"🧪 Mock Gemini API on http://127.0.0.1:{args.port}/v1beta")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
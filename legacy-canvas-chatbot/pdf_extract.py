@@ -0,0 +1,336 @@
+import os
+import re
+import errno
+import mmap
+import time
+import signal
+import tempfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import PyPDF2
+
+import http_client
+
+try:
+    import resource
+except ImportError:  # Windows - CPU/memory limits are not enforced
+    resource = None
+
+# PDF text extraction runs in its own process pool so PyPDF2 never holds the
+# GIL of a request-serving process. Large documents are split into page ranges
+# that are extracted in parallel.
+PDF_PROCESS_WORKERS = 2
+PDF_PAGES_PER_TASK = 10
+
+# Per-document limits. The CPU budget is shared between a document's page
+# ranges. The memory limit is headroom on top of what each worker already has
+# mapped when it starts (the interpreter, PyPDF2 and its dependencies). When a
+# limit or the wall-clock deadline is hit, the text extracted so far is
+# returned.
+PDF_CPU_LIMIT_SECONDS = 20
+PDF_MEMORY_LIMIT_BYTES = 1024 * 1024 * 1024  # 1 GB
+PDF_DEADLINE_SECONDS = 25
+
+# Downloads are streamed to a temp file in chunks, so worker RSS stays bounded
+# however large the PDF is. Anything over PDF_MAX_BYTES is refused, both by
+# Content-Length up front and by counting bytes while streaming.
+PDF_MAX_BYTES = 100 * 1024 * 1024  # 100 MB
+PDF_DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PDFDownloadError(Exception):
+    pass
+
+
+class PDFTooLargeError(PDFDownloadError):
+    pass
+
+
+class _CPUTimeExceeded(Exception):
+    pass
+
+
+def _on_cpu_limit(signum, frame):
+    raise _CPUTimeExceeded()
+
+
+def _virtual_memory_size():
+    """This process's current VmSize in bytes, or None where /proc isn't available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _init_worker(memory_headroom):
+    if resource is None:
+        return
+    signal.signal(signal.SIGXCPU, _on_cpu_limit)
+
+    current = _virtual_memory_size()
+    if current is None:
+        print("⚠️ Cannot read VmSize, PDF workers run without a memory limit")
+        return
+    soft = current + memory_headroom
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def _limit_cpu(seconds):
+    """Cap this worker's CPU time at `seconds` from now; returns the previous limits"""
+    if resource is None:
+        return None
+    previous = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    hard = previous[1]
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    return previous
+
+
+@contextmanager
+def _mapped_reader(path):
+    """Open a PdfReader over a read-only memory map of the file"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        yield PyPDF2.PdfReader(view)
+
+
+def _page_count(path):
+    """Number of pages, or None if the worker ran out of address space opening the file"""
+    try:
+        with _mapped_reader(path) as reader:
+            return len(reader.pages)
+    except MemoryError:
+        return None
+    except OSError as e:
+        if e.errno == errno.ENOMEM:
+            return None
+        raise
+
+
+def _extract_range(path, start, end, cpu_limit, deadline, char_budget=None):
+    """
+    Worker: extract pages [start, end), whitespace-normalised page by page.
+
+    Stops early once char_budget characters have been collected. Returns
+    (page_texts, complete) where complete is False if a limit or the
+    deadline cut the range short.
+    """
+    texts = []
+    collected = 0
+    previous = _limit_cpu(cpu_limit)
+    try:
+        with _mapped_reader(path) as reader:
+            for page_num in range(start, min(end, len(reader.pages))):
+                if time.time() >= deadline:
+                    return texts, False
+                page_text = _WHITESPACE_RE.sub(' ', reader.pages[page_num].extract_text() or '').strip()
+                texts.append(page_text)
+                collected += len(page_text) + 1
+                if char_budget is not None and collected >= char_budget:
+                    break
+        return texts, True
+    except (_CPUTimeExceeded, MemoryError):
+        return texts, False
+    except OSError as e:
+        # mmap and friends report the address-space limit as ENOMEM rather than MemoryError
+        if e.errno == errno.ENOMEM:
+            return texts, False
+        raise
+    finally:
+        if previous is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, previous)
+
+
+def _pool_context():
+    """
+    Start method for the pool. The app is multithreaded by the time the first
+    PDF arrives, and forking it then can copy locks held by other threads into
+    the children, so workers come from a forkserver: a single-threaded process
+    that imports the main module and this one once, and forks each worker
+    from there.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return None  # Windows - spawn
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['__main__', __name__])
+    return context
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_PROCESS_WORKERS,
+                mp_context=_pool_context(),
+                initializer=_init_worker,
+                initargs=(PDF_MEMORY_LIMIT_BYTES,)
+            )
+        return _pool
+
+
+def _reset_pool():
+    """Drop a pool whose worker died (e.g. killed by the OOM killer) so the next call starts fresh"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+@contextmanager
+def spooled_pdf(chunks, max_bytes=PDF_MAX_BYTES):
+    """
+    Write an iterable of byte chunks to a temp file and yield its path.
+
+    Raises PDFTooLargeError as soon as more than max_bytes arrive. The file is
+    removed when the block exits.
+    """
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        written = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                written += len(chunk)
+                if written > max_bytes:
+                    raise PDFTooLargeError(f"PDF is larger than {max_bytes} bytes")
+                f.write(chunk)
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@contextmanager
+def downloaded_pdf(url, headers, max_bytes=PDF_MAX_BYTES, timeout=30):
+    """Stream a PDF download into a temp file and yield its path"""
+    with http_client.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            raise PDFDownloadError(f"PDF fetch failed: {response.status_code}")
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise PDFTooLargeError(f"PDF is {content_length} bytes, over the {max_bytes} byte limit")
+
+        with spooled_pdf(response.iter_content(PDF_DOWNLOAD_CHUNK_BYTES), max_bytes) as path:
+            yield path
+
+
+def extract_pdf_pages(source, max_pages=None, start_page=0, char_budget=None):
+    """
+    Extract text from a PDF given as bytes or a file path.
+
+    Pages are read from start_page in ranges of PDF_PAGES_PER_TASK, with at
+    most PDF_PROCESS_WORKERS ranges in flight. No further pages are read once
+    char_budget characters have been collected.
+
+    Returns a dict with the joined 'text' (trimmed to char_budget), the page
+    range it covers as 'start_page'/'end_page' (end exclusive - pass it as
+    start_page to continue; the last covered page may be cut at the budget),
+    'page_count' and 'complete' (False when a CPU, memory or deadline limit
+    stopped extraction early).
+    """
+    deadline = time.time() + PDF_DEADLINE_SECONDS
+    tmp_path = None
+    if isinstance(source, (bytes, bytearray)):
+        # Workers get a path rather than a pickled copy of the whole document
+        fd, tmp_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(source)
+        path = tmp_path
+    else:
+        path = source
+
+    try:
+        pool = _get_pool()
+        count_future = pool.submit(_page_count, path)
+        try:
+            page_count = count_future.result(timeout=PDF_DEADLINE_SECONDS)
+        except FuturesTimeoutError:
+            # Don't leave it queued to run later against a file that is about to be removed
+            count_future.cancel()
+            page_count = None
+        if page_count is None:
+            return {'text': '', 'start_page': start_page, 'end_page': start_page, 'page_count': 0, 'complete': False}
+        last_page = page_count if max_pages is None else min(page_count, start_page + max_pages)
+
+        ranges = [(start, min(start + PDF_PAGES_PER_TASK, last_page))
+                  for start in range(start_page, last_page, PDF_PAGES_PER_TASK)]
+        cpu_per_range = max(1, PDF_CPU_LIMIT_SECONDS // max(1, len(ranges)))
+
+        parts = []
+        collected = 0
+        next_page = start_page
+        complete = True
+        in_flight = deque()
+        pending = deque(ranges)
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < PDF_PROCESS_WORKERS:
+                    start, end = pending.popleft()
+                    budget = None if char_budget is None else char_budget - collected
+                    in_flight.append(pool.submit(_extract_range, path, start, end, cpu_per_range, deadline, budget))
+
+                # Small grace past the deadline for workers to hand back partial text
+                future = in_flight.popleft()
+                texts, range_complete = future.result(timeout=max(0, deadline - time.time()) + 2)
+                for page_text in texts:
+                    if page_text:
+                        parts.append(page_text)
+                        collected += len(page_text) + 1
+                    next_page += 1
+                    if char_budget is not None and collected >= char_budget:
+                        break
+
+                if not range_complete:
+                    complete = False
+                    break
+                if char_budget is not None and collected >= char_budget:
+                    break
+        except FuturesTimeoutError:
+            complete = False
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+        text = ' '.join(parts)
+        if char_budget is not None:
+            text = text[:char_budget]
+        return {
+            'text': text,
+            'start_page': start_page,
+            'end_page': next_page,
+            'page_count': page_count,
+            'complete': complete,
+        }
+    except BrokenProcessPool:
+        _reset_pool()
+        raise
+    finally:
+        if tmp_path:
+            # Workers still running a cancelled range keep their open handle; unlinking is safe on POSIX
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,108 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Shared pool for short blocking Canvas work (course lists, assignment scans,
+# page prefetch, model probes). Size it to at least HTTP_POOL_MAXSIZE so no
+# thread waits on a pooled connection.
+CANVAS_FETCH_WORKERS = 32
+
+# Separate pool for module items (pages, PDFs, transcripts), which can run for
+# tens of seconds. However many students have items in flight, the short work
+# above never waits behind them for a thread.
+BULK_FETCH_WORKERS = 16
+
+# Max in-flight fetches per user, so one big module summary can't take the
+# whole pool while other students are waiting
+PER_USER_CONCURRENCY = 6
+
+# Module items are slow and may outlive the request that asked for them, so
+# they queue in a separate lane per user, with its own cap, on bulk_executor
+PER_USER_BULK_CONCURRENCY = 6
+
+executor = ThreadPoolExecutor(max_workers=CANVAS_FETCH_WORKERS, thread_name_prefix='canvas-fetch')
+bulk_executor = ThreadPoolExecutor(max_workers=BULK_FETCH_WORKERS, thread_name_prefix='canvas-bulk')
+
+
+class _UserQueue:
+    def __init__(self, limit, pool):
+        self.limit = limit
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.running = 0
+        self.pending = deque()
+
+
+_user_queues = {}
+_user_queues_lock = threading.Lock()
+
+
+def _get_user_queue(user_id, lane, limit, pool):
+    with _user_queues_lock:
+        queue = _user_queues.get((user_id, lane))
+        if queue is None:
+            queue = _UserQueue(limit, pool)
+            _user_queues[(user_id, lane)] = queue
+        return queue
+
+
+def _run(queue, future, fn, args, kwargs):
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+    finally:
+        _start_next(queue)
+
+
+def _submit(queue, future, fn, args, kwargs):
+    try:
+        queue.pool.submit(_run, queue, future, fn, args, kwargs)
+    except Exception as e:
+        future.set_exception(e)
+        _start_next(queue)
+
+
+def _start_next(queue):
+    """Hand the finished task's slot to the user's next queued task, skipping cancelled ones"""
+    while True:
+        with queue.lock:
+            if not queue.pending:
+                queue.running -= 1
+                return
+            future, fn, args, kwargs = queue.pending.popleft()
+        if future.set_running_or_notify_cancel():
+            break
+    _submit(queue, future, fn, args, kwargs)
+
+
+def _submit_to_queue(queue, fn, args, kwargs):
+    future = Future()
+    with queue.lock:
+        if queue.running >= queue.limit:
+            queue.pending.append((future, fn, args, kwargs))
+            return future
+        queue.running += 1
+
+    future.set_running_or_notify_cancel()
+    _submit(queue, future, fn, args, kwargs)
+    return future
+
+
+def submit_for_user(user_id, fn, *args, **kwargs):
+    """
+    Run fn on the shared pool, at most PER_USER_CONCURRENCY at a time per user.
+
+    Never blocks: over the cap, the task is queued and started when one of
+    the user's running tasks finishes. A queued task can still be cancelled
+    through the returned future. Tasks must not submit and wait on further
+    pool work themselves.
+    """
+    return _submit_to_queue(_get_user_queue(user_id, 'interactive', PER_USER_CONCURRENCY, executor), fn, args, kwargs)
+
+
+def submit_bulk_for_user(user_id, fn, *args, **kwargs):
+    """Like submit_for_user, but in the user's bulk lane (PER_USER_BULK_CONCURRENCY) on bulk_executor"""
+    return _submit_to_queue(_get_user_queue(user_id, 'bulk', PER_USER_BULK_CONCURRENCY, bulk_executor), fn, args, kwargs)